@@ -0,0 +1,28 @@
+"""
+--------------------------------------------------------------------------------
+Share the CPUs among the BLAS threads of parallel fold workers
+--------------------------------------------------------------------------------
+BLAS libraries read their thread counts once, when numpy and Theano are
+imported, and forked workers inherit them. Scripts call set_blas_threads()
+in their __main__ block before importing anything else, so this module
+imports only the standard library.
+"""
+import os, argparse
+from multiprocessing import cpu_count
+
+BLAS_THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+def set_blas_threads(argv):
+    """
+    Set the OMP/OpenBLAS/MKL thread counts to an even share of the CPUs
+    for each of the fold workers asked for with -j/--n_jobs in argv (0 for
+    all CPUs). Does nothing for -j 1 or when one of them is set already.
+    """
+    p = argparse.ArgumentParser(add_help=False)
+    p.add_argument('-j', '--n_jobs', type=int, default=1)
+    n_jobs = p.parse_known_args(argv)[0].n_jobs
+    if n_jobs == 1 or any(var in os.environ for var in BLAS_THREAD_VARS):
+        return
+    blas_threads = max(1, cpu_count() / min(n_jobs or cpu_count(), cpu_count()))
+    for var in BLAS_THREAD_VARS:
+        os.environ[var] = str(blas_threads)
@@ -0,0 +1,113 @@
+"""
+--------------------------------------------------------------------------------
+Script for fitting the contour gate of main.py on the cross validation folds of
+a feature bank, and choosing its thresholds from the CNN calls they save and
+the accuracy they cost
+--------------------------------------------------------------------------------
+"""
+import os
+import numpy as np
+from guitar_trans import np_models
+from guitar_trans import parameters as pm
+from guitar_trans.features import fit_melody_window
+from guitar_trans.gating import ContourGate
+
+THRESHOLDS = [0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.975, 0.99, 0.995]
+
+def load_folds(feature_bank, direction, mc_dir):
+    ### (clips, melody windows, answers) of the original clips of each fold
+    folds = []
+    for fold in feature_bank[direction]:
+        data = [t for t in fold if 'aug' not in t[-1]]
+        mc = [fit_melody_window(np.loadtxt(os.path.join(mc_dir, t[-1] + '.MIDI.melody'), dtype='float32'))
+              for t in data]
+        ans = np.array([np.argmax(t[-2]) for t in data], dtype=int)
+        folds.append((data, np.array(mc).reshape(-1, pm.MC_LENGTH), ans))
+    return folds
+
+def cross_validate(folds, direction, model_dir=None):
+    """
+    Gate probabilities of every clip from a gate fitted on the other folds,
+    the answers, and with model_dir, the classes predicted by the CNN of
+    the clip's fold (<model_dir>/<name>_<fold>.<direction>.npz).
+    """
+    prob, ans, cnn = [], [], []
+    for idx, (data, mc, fold_ans) in enumerate(folds):
+        train_mc = np.concatenate([f[1] for i, f in enumerate(folds) if i != idx])
+        train_ans = np.concatenate([f[2] for i, f in enumerate(folds) if i != idx])
+        gate = ContourGate().fit(direction, train_mc, train_ans)
+        prob.append(gate.predict_proba(direction, mc))
+        ans.append(fold_ans)
+        if model_dir is not None:
+            name = os.path.basename(os.path.normpath(model_dir))
+            model_fp = os.path.join(model_dir, '{}_{}.{}.npz'.format(name, idx, direction))
+            cnn.append(np.argmax(np_models.NumpyModel.init_from_file(model_fp).run(data), axis=1))
+    return np.concatenate(prob), np.concatenate(ans), (np.concatenate(cnn) if cnn else None)
+
+def calibrate(prob, ans, cnn=None, min_gate_acc=0.97, max_drop=0.005):
+    """
+    Print the share of clips labeled by the gate and the accuracies for
+    each of THRESHOLDS, and return the lowest threshold whose gated clips
+    are at least min_gate_acc correct, or with cnn, whose gate + CNN
+    accuracy is at most max_drop below the CNN alone (inf if none is).
+    """
+    conf = np.where(np.all(np.isfinite(prob), axis=1), np.max(prob, axis=1), 0.)
+    gate_pred = np.argmax(np.nan_to_num(prob), axis=1)
+    cnn_acc = np.mean(cnn == ans) if cnn is not None else None
+    row_format = "{:>10}" + "{:>12}" * 4
+    print(row_format.format('Threshold', 'CNN saved', 'Gate acc', 'Total acc', 'CNN acc'))
+    best = np.inf
+    for threshold in THRESHOLDS:
+        gated = conf >= threshold
+        gate_acc = np.mean(gate_pred[gated] == ans[gated]) if gated.any() else np.nan
+        total_acc = np.mean(np.where(gated, gate_pred, cnn) == ans) if cnn is not None else np.nan
+        print(row_format.format(threshold, '{:.2f} %'.format(gated.mean() * 100), '{:.4f}'.format(gate_acc),
+                                '{:.4f}'.format(total_acc), '{:.4f}'.format(cnn_acc if cnn is not None else np.nan)))
+        if best < np.inf or not gated.any():
+            continue
+        if (cnn is None and gate_acc >= min_gate_acc) or (cnn is not None and total_acc >= cnn_acc - max_drop):
+            best = threshold
+    return best
+
+def main(feature_bank_fp, mc_dir, save_fp, model_dir=None, min_gate_acc=0.97, max_drop=0.005):
+    feature_bank = np.load(feature_bank_fp).item()
+    gate = ContourGate()
+    for direction in feature_bank:
+        print('===== {} ====='.format(direction))
+        folds = load_folds(feature_bank, direction, mc_dir)
+        prob, ans, cnn = cross_validate(folds, direction, model_dir)
+        threshold = calibrate(prob, ans, cnn, min_gate_acc, max_drop)
+        print('Threshold: {}'.format(threshold))
+        gate.fit(direction, np.concatenate([f[1] for f in folds]), np.concatenate([f[2] for f in folds]),
+                 threshold=threshold)
+    gate.save(save_fp)
+    print('Saved gate to {}.'.format(save_fp))
+
+def parser():
+    import argparse
+    p = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=
+    """
+=======================================================================
+Script for calibrating the contour gate used by main.py (-g).
+=======================================================================
+    """)
+
+    p.add_argument('feature_bank', type=str, metavar='feature_bank',
+                    help='A feature bank saved by classification.py.')
+    p.add_argument('mc_dir', type=str, metavar='mc_dir',
+                    help='The melody directory of the data the feature bank was extracted from.')
+    p.add_argument('-o', '--save_fp', type=str, default='gate.npz',
+                    help='The file path of the calibrated gate. Default: gate.npz')
+    p.add_argument('-m', '--model_dir', type=str, default=None,
+                    help='The directory of the CNN fold models (model/<name>). If given, thresholds are chosen by the accuracy of gate + CNN.')
+    p.add_argument('-a', '--min_gate_acc', type=float, default=0.97,
+                    help='Without -m, the lowest accuracy allowed on the clips the gate labels. Default: 0.97')
+    p.add_argument('-d', '--max_drop', type=float, default=0.005,
+                    help='With -m, the largest accuracy drop allowed against the CNN alone. Default: 0.005')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = parser()
+    main(args.feature_bank, args.mc_dir, args.save_fp, args.model_dir, args.min_gate_acc, args.max_drop)
@@ -0,0 +1,92 @@
+"""
+--------------------------------------------------------------------------------
+Count the NumPy allocations contour.py makes while tent() tracks a melody, for
+several revisions of guitar_trans
+--------------------------------------------------------------------------------
+Python 2 has no tracemalloc, so a profile hook counts the allocating NumPy calls
+(array, empty, zeros, copy, astype, append, concatenate...) whose caller is
+contour.py. np.array(seq, copy=copy) calls with copy False are not counted, as
+they reuse seq.
+
+Usage: python checks/bench_contour_alloc.py [-m FilteredMelody.txt] [rev ...]
+    rev: git revisions to compare, or "." for the working tree.
+         Default: the revisions before and after Contour views (3b974e9) and "."
+"""
+import os, sys, time, shutil, tempfile, subprocess
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ALLOC_NAMES = set(['array', 'empty', 'zeros', 'ones', 'copy', 'astype', 'concatenate', 'fromiter', 'ravel'])
+
+def count_allocations(tree, mc):
+    ### Import the modules directly, as older package __init__s import Theano models
+    sys.path.insert(0, os.path.join(tree, 'guitar_trans'))
+    from te_note_tracking import tent
+    from contour import Contour
+    py_allocs = set(f.__code__ for f in (np.append, np.copy))
+    counts = {}
+    def hook(frame, event, arg):
+        if event == 'c_call':
+            name, caller = getattr(arg, '__name__', ''), frame.f_code
+            owner = getattr(arg, '__self__', None)
+            if name not in ALLOC_NAMES or not (owner is None or isinstance(owner, np.ndarray) or
+                                               getattr(owner, '__name__', '').startswith('numpy')):
+                return
+            if name == 'array' and frame.f_locals.get('copy') is False:
+                return
+        elif event == 'call' and frame.f_code in py_allocs:
+            name, caller = frame.f_code.co_name, frame.f_back.f_code
+        else:
+            return
+        if os.path.basename(caller.co_filename).startswith('contour.py'):
+            counts[name] = counts.get(name, 0) + 1
+    melody = Contour(0, mc)
+    start_time = time.time()
+    sys.setprofile(hook)
+    try:
+        _, _, notes = tent(melody)
+    finally:
+        sys.setprofile(None)
+    return counts, len(notes), time.time() - start_time
+
+def export_tree(rev, dst):
+    if rev == '.':
+        return ROOT
+    archive = subprocess.Popen(['git', '-C', ROOT, 'archive', rev, 'guitar_trans'], stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', dst], stdin=archive.stdout)
+    archive.wait()
+    return dst
+
+def main(revs, melody_fp=None):
+    if melody_fp is None:
+        from check_tent_streaming import synth_melody
+        mc_fp = tempfile.mktemp(suffix='.txt')
+        np.savetxt(mc_fp, synth_melody(1), fmt='%.3f')
+    else:
+        mc_fp = melody_fp
+    row_format = "{:>14}" + "{:>12}" * 3
+    print(row_format.format('Revision', 'Allocations', 'Notes', 'Seconds'))
+    for rev in revs:
+        tmp = tempfile.mkdtemp()
+        try:
+            tree = export_tree(rev, tmp)
+            ### Each revision runs in its own process, so its modules are imported fresh
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run', tree, mc_fp])
+            counts, n_notes, seconds = eval(out.strip().splitlines()[-1])
+            print(row_format.format(rev, sum(counts.values()), n_notes, '{:.2f}'.format(seconds)))
+            print('    ' + ', '.join('{}: {}'.format(k, v) for k, v in sorted(counts.items())))
+        finally:
+            shutil.rmtree(tmp)
+    if melody_fp is None:
+        os.remove(mc_fp)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        print(repr(count_allocations(sys.argv[2], np.loadtxt(sys.argv[3]))))
+    else:
+        import argparse
+        p = argparse.ArgumentParser()
+        p.add_argument('revs', nargs='*', default=['3b974e9^', '3b974e9', '.'])
+        p.add_argument('-m', '--melody', type=str, default=None)
+        args = p.parse_args()
+        main(args.revs, args.melody)
@@ -0,0 +1,56 @@
+"""
+--------------------------------------------------------------------------------
+Measure the size of Note and Tech objects, the cost of reading techs, and the
+objects all_techs allocates, for several revisions of guitar_trans
+--------------------------------------------------------------------------------
+Usage: python checks/bench_note_alloc.py [rev ...]
+    rev: git revisions to compare, or "." for the working tree.
+         Default: the revisions before and after __slots__ and Tech.of() (3111bbb) and "."
+"""
+import os, sys, gc, timeit, shutil, tempfile, subprocess
+from bench_contour_alloc import export_tree
+
+N_CALLS = 200000
+
+def size(obj):
+    s = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'): s += sys.getsizeof(obj.__dict__)
+    return s
+
+def measure(tree):
+    ### Import the modules directly, as older package __init__s import Theano models
+    sys.path.insert(0, os.path.join(tree, 'guitar_trans'))
+    from note import CandidateNote
+    from technique import Tech, T_BEND
+    nt = CandidateNote(60, 10, 20, techs=[Tech(T_BEND, 1)])
+    result = {'note_bytes': size(nt), 'tech_bytes': size(Tech(T_BEND, 1))}
+    result['tech_us'] = timeit.timeit(lambda: nt.tech(T_BEND).value, number=N_CALLS) / N_CALLS * 1e6
+    if hasattr(nt, 'tech_value'):
+        result['tech_value_us'] = timeit.timeit(lambda: nt.tech_value(T_BEND), number=N_CALLS) / N_CALLS * 1e6
+    result['all_techs_us'] = timeit.timeit(lambda: nt.all_techs, number=N_CALLS / 10) / (N_CALLS / 10) * 1e6
+    gc.collect()
+    before = len(gc.get_objects())
+    keep = [nt.all_techs for _ in range(10000)]
+    result['all_techs_objects'] = (len(gc.get_objects()) - before) / 10000.
+    return result
+
+def main(revs):
+    keys = ['note_bytes', 'tech_bytes', 'tech_us', 'tech_value_us', 'all_techs_us', 'all_techs_objects']
+    row_format = "{:>10}" + "{:>18}" * len(keys)
+    print(row_format.format('Revision', *keys))
+    for rev in revs:
+        tmp = tempfile.mkdtemp()
+        try:
+            tree = export_tree(rev, tmp)
+            ### Each revision runs in its own process, so its modules are imported fresh
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run', tree])
+            result = eval(out.strip().splitlines()[-1])
+            print(row_format.format(rev, *['{:.2f}'.format(result[k]) if k in result else '-' for k in keys]))
+        finally:
+            shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        print(repr(measure(sys.argv[2])))
+    else:
+        main(sys.argv[1:] or ['3111bbb^', '3111bbb', '.'])
@@ -0,0 +1,77 @@
+"""
+--------------------------------------------------------------------------------
+Compare the training loss of RawNetModel on one clip per SGD step with that on
+length-bucketed batches
+--------------------------------------------------------------------------------
+The three models start from the same random weights and see the same synthetic
+clips: each class has its own melody shape and tone, and clips have random
+lengths around those of the candidate clips. Melodies are centred at pitch 0:
+raw MIDI pitches saturate the randomly initialized network, and none of the
+three then learns.
+    per clip:   BATCH_SIZE 1, learning rate LEARNING_RATE (the old training)
+    bucketed:   BATCH_SIZE 10, learning rate LEARNING_RATE * BATCH_SIZE
+    unscaled:   BATCH_SIZE 10, learning rate LEARNING_RATE
+
+Usage: python checks/bench_rawnet_training.py [n_epochs] [n_clips]
+"""
+import os, sys, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import lasagne
+from guitar_trans import models
+from guitar_trans import parameters as pm
+
+class PerClipModel(models.RawNetModel):
+    BATCH_SIZE = 1
+
+class UnscaledModel(models.RawNetModel):
+    LEARNING_RATE = models.RawNetModel.LEARNING_RATE / models.RawNetModel.BATCH_SIZE
+
+def synth_clips(n_clips, seed=0):
+    rs = np.random.RandomState(seed)
+    clips = []
+    for i in range(n_clips):
+        label = i % pm.NUM_CLASS
+        n_mc = rs.randint(pm.MC_LENGTH - 5, pm.MC_LENGTH + 10)
+        t = np.linspace(-1, 1, n_mc)
+        shape = [t, -t, np.sin(np.pi * t), np.zeros(n_mc), np.abs(t)][label % 5]
+        mc = 2 * shape + rs.randn(n_mc) * 0.1
+        n_ra = rs.randint(3000, 9000)
+        ra = 0.3 * np.sin(2 * np.pi * (200 + 100 * label) * np.arange(n_ra) / pm.SAMPLING_RATE)
+        ra = (ra + rs.randn(n_ra) * 0.05).astype('float32')
+        ans = np.zeros(pm.NUM_CLASS, dtype='int32')
+        ans[label] = 1
+        clips.append(models.RawFeature.extract_features(ra, mc, 'clip_{}'.format(i), ans))
+    return clips
+
+def train(model, params, train_list, val_list, n_epochs, seed=0):
+    lasagne.layers.set_all_param_values(model.network, params)
+    random.seed(seed)
+    lasagne.random.get_rng().seed(seed)
+    history = []
+    for epoch in range(n_epochs):
+        start_time = time.time()
+        train_err, train_batches = model.train_one(train_list)
+        val_err, val_acc, val_batches = model.val_one(val_list)
+        history.append((train_err / train_batches, val_err / val_batches, val_acc / val_batches * 100,
+                        train_batches, time.time() - start_time))
+    return history
+
+def main(n_epochs=15, n_clips=200):
+    np.random.seed(0)
+    lasagne.random.set_rng(np.random.RandomState(0))
+    model_list = [('per clip', PerClipModel), ('bucketed', models.RawNetModel), ('unscaled', UnscaledModel)]
+    model_list = [(name, cls(pm.raw_net_opts, None)) for name, cls in model_list]
+    params = lasagne.layers.get_all_param_values(model_list[0][1].network)
+    clips = synth_clips(n_clips)
+    val_list, train_list = clips[:n_clips / 5], clips[n_clips / 5:]
+    row_format = "{:>10}{:>7}{:>12}{:>12}{:>9}{:>7}{:>9}"
+    print(row_format.format('Model', 'Epoch', 'Train loss', 'Val loss', 'Val acc', 'Steps', 'Seconds'))
+    for name, model in model_list:
+        for epoch, (train_loss, val_loss, val_acc, steps, sec) in enumerate(train(model, params, train_list, val_list, n_epochs)):
+            print(row_format.format(name, epoch + 1, '{:.4f}'.format(train_loss), '{:.4f}'.format(val_loss),
+                                    '{:.1f}'.format(val_acc), steps, '{:.1f}'.format(sec)))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
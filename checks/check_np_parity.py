@@ -0,0 +1,102 @@
+"""
+--------------------------------------------------------------------------------
+Check that np_models gives the predictions of the Theano/Lasagne models
+--------------------------------------------------------------------------------
+Usage: python checks/check_np_parity.py model.npz [-f feature_bank.npy]
+    Load model.npz with models.Model and np_models.NumpyModel and report the
+    largest absolute difference between their class probabilities, on the test
+    fold of the feature bank or on clips of a synthetic signal.
+       python checks/check_np_parity.py --ops
+    Compare the NumPy layers with the Theano ops the Lasagne layers are built on,
+    which does not need Lasagne or a trained model.
+"""
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+from guitar_trans import np_models
+from guitar_trans import parameters as pm
+
+TOLERANCE = 1e-4
+
+def synth_features(model, n_clips=200, seed=0):
+    from check_song_features import synth_audio, N_BIN
+    rs = np.random.RandomState(seed)
+    audio = synth_audio(seed=seed)
+    feature_list = []
+    for start_bin in rs.randint(0, len(audio) - N_BIN, n_clips):
+        mc = 60 + np.cumsum(rs.randn(pm.MC_LENGTH) * 0.2)
+        feature_list.append(model.extract_features(audio[start_bin:start_bin + N_BIN], mc, 'clip'))
+    return feature_list
+
+def bank_features(model_fp, feature_bank_fp):
+    from quantize_model import model_fold
+    fold, direction = model_fold(model_fp)
+    feature_bank = np.load(feature_bank_fp).item()
+    return [(t[0], t[-1]) for t in feature_bank[direction][fold] if 'aug' not in t[-1]]
+
+def check_model(model_fp, feature_bank_fp=None):
+    from guitar_trans import models
+    th_model = models.Model.init_from_file(model_fp, inference=True)
+    np_model = np_models.NumpyModel.init_from_file(model_fp)
+    if feature_bank_fp is None:
+        feature_list = synth_features(np_model)
+    else:
+        feature_list = bank_features(model_fp, feature_bank_fp)
+    th_pred = th_model.run(feature_list)
+    np_pred = np_model.run(feature_list)
+    diff = np.abs(th_pred - np_pred).max()
+    same = np.mean(np.argmax(th_pred, axis=1) == np.argmax(np_pred, axis=1))
+    print('{}: {} features, max abs difference {:.2e}, same class for {:.2%}'.format(
+          os.path.basename(model_fp), len(feature_list), diff, same))
+    return diff <= TOLERANCE
+
+def check_ops(seed=0):
+    import theano
+    import theano.tensor as T
+    from theano.tensor.signal.pool import pool_2d
+    rs = np.random.RandomState(seed)
+    x_var, W_var = T.tensor4('x'), T.tensor4('W')
+    ok = True
+    def report(name, np_out, th_out):
+        diff = np.abs(np_out - th_out).max() if np_out.shape == th_out.shape else np.inf
+        print('{:<32} max abs difference {:.2e}'.format(name, diff))
+        return diff <= TOLERANCE
+
+    ### Conv1DLayer convolves (batch, channel, 1, time) with flipped filters
+    for stride, pad, border in ((1, 0, 'valid'), (2, 0, 'valid'), (1, 'same', 'half')):
+        conv_fn = theano.function([x_var, W_var], T.nnet.conv2d(x_var, W_var, border_mode=border,
+                                                                subsample=(1, stride), filter_flip=True))
+        x = rs.randn(8, 41, 25).astype('float32')
+        W = rs.randn(16, 41, 3).astype('float32')
+        b = rs.randn(16).astype('float32')
+        th_out = conv_fn(x[:, :, None], W[:, :, None])[:, :, 0] + b.reshape(1, -1, 1)
+        ok = report('conv1d stride={} pad={}'.format(stride, pad), np_models.conv1d(x, W, b, stride, pad), th_out) and ok
+
+    ### Pool1DLayer pools (batch, channel, time, 1)
+    for mode in np_models.POOL_MODES:
+        for length in (24, 25):
+            pool_fn = theano.function([x_var], pool_2d(x_var, ws=(2, 1), ignore_border=False, mode=mode))
+            x = rs.randn(8, 16, length).astype('float32')
+            th_out = pool_fn(x[:, :, :, None])[:, :, :, 0]
+            ok = report('pool1d {} length={}'.format(mode, length), np_models.pool1d(x, 2, mode), th_out) and ok
+    try:
+        np_models.pool1d(x, 2, 'average_inc_pad')
+        print('pool1d accepted average_inc_pad')
+        ok = False
+    except ValueError:
+        pass
+    return ok
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser()
+    p.add_argument('model_fp', type=str, nargs='?')
+    p.add_argument('-f', '--feature_bank', type=str, default=None)
+    p.add_argument('--ops', action='store_true')
+    args = p.parse_args()
+    if args.ops or args.model_fp is None:
+        ok = check_ops()
+    else:
+        ok = check_model(args.model_fp, args.feature_bank)
+    print('PASSED' if ok else 'FAILED')
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,47 @@
+"""
+--------------------------------------------------------------------------------
+Check that RawNetModel predicts the same for a clip zero-padded in a bucket of
+longer clips as for the clip alone
+--------------------------------------------------------------------------------
+The network is randomly initialized; clips have random raw audio and melody
+contour lengths around those of the candidate clips.
+
+Usage: python checks/check_rawnet_buckets.py [model.npz]
+"""
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+from guitar_trans import models
+from guitar_trans import parameters as pm
+
+TOLERANCE = 1e-5
+
+def synth_clips(n_clips=40, seed=0):
+    rs = np.random.RandomState(seed)
+    clips = []
+    for i in range(n_clips):
+        ra = rs.randn(rs.randint(3000, 9000)).astype('float32') * 0.1
+        mc = 60 + np.cumsum(rs.randn(rs.randint(pm.MC_LENGTH - 5, pm.MC_LENGTH + 10)) * 0.2)
+        clips.append(models.RawFeature.extract_features(ra, mc, 'clip_{}'.format(i)))
+    return clips
+
+def check(model):
+    clips = synth_clips()
+    alone = np.concatenate([model.run([clip], batch_size=1) for clip in clips])
+    ok = True
+    for batch_size in (4, 10, len(clips)):
+        bucketed = model.run(clips, batch_size=batch_size)
+        diff = np.abs(bucketed - alone).max()
+        print('{} clips in buckets of {}: max abs difference to clips alone {:.2e}'.format(
+              len(clips), batch_size, diff))
+        ok = ok and diff <= TOLERANCE
+    return ok
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        model = models.Model.init_from_file(sys.argv[1], inference=True)
+    else:
+        model = models.RawNetModel(pm.raw_net_opts, None, inference=True)
+    ok = check(model)
+    print('PASSED' if ok else 'FAILED')
+    sys.exit(0 if ok else 1)
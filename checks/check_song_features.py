@@ -0,0 +1,84 @@
+"""
+--------------------------------------------------------------------------------
+Check that SongFeatures.window() gives the per-clip features of extract_features()
+for the interior frames of a candidate clip, and that only the edge frames differ
+--------------------------------------------------------------------------------
+The edge frames are the ones whose analysis window reaches past the clip: one
+frame on each side for the spectra (n_fft = 2 * HOP_LENGTH), and the 5 frames
+rosa.feature.delta() (width 9) interpolates from them for the deltas. The mel
+frames inside match exactly. The MFCCs inside can differ slightly where the log
+power is floored, since the floor is 80 dB below the loudest frame, which may
+be an edge frame.
+
+Usage: python checks/check_song_features.py [audio.wav]
+"""
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import librosa as rosa
+from guitar_trans import parameters as pm
+from guitar_trans.features import SongFeatures, MFCCFeature, SpecFeature, CocktailFeature
+
+N_BIN = int(round(0.14 * pm.SAMPLING_RATE))
+EDGE = {'melspec': 1, 'mfcc': 1, 'mfcc_d': 5, 'mfcc_d2': 5}
+TOLERANCE = {'melspec': 1e-5, 'mfcc': 2e-2, 'mfcc_d': 2e-2, 'mfcc_d2': 2e-2}
+
+def synth_audio(seconds=10., seed=0):
+    ### Plucked notes with glides and vibrato, plus noise
+    rs = np.random.RandomState(seed)
+    sr = pm.SAMPLING_RATE
+    t = np.arange(int(seconds * sr)) / float(sr)
+    pitch = 60 + np.cumsum(rs.randn(len(t)) * 0.002) + 0.3 * np.sin(2 * np.pi * 5 * t)
+    freq = 440. * 2 ** ((pitch - 69) / 12.)
+    phase = 2 * np.pi * np.cumsum(freq) / sr
+    env = np.exp(-3 * (t % 0.5))
+    y = sum(np.sin(k * phase) / k for k in range(1, 6)) * env
+    return (y + rs.randn(len(t)) * 0.01).astype('float32')
+
+def relative_diff(a, b):
+    return np.abs(a - b).max(axis=0) / (np.abs(b).max() + 1e-12)
+
+def check(audio, n_clips=50, seed=0):
+    song_feat = SongFeatures(audio)
+    n_frames = (len(audio) - N_BIN) // pm.HOP_LENGTH
+    starts = np.random.RandomState(seed).randint(0, n_frames, n_clips)
+    interior_err = dict((name, 0.) for name in EDGE)
+    edge_err = dict((name, 0.) for name in EDGE)
+    for start_i in starts:
+        clip_feat = SongFeatures(song_feat.clip(start_i, N_BIN))
+        window_feat = song_feat.window(start_i)
+        for name, edge in EDGE.items():
+            diff = relative_diff(window_feat.matrix(name), clip_feat.matrix(name))
+            interior_err[name] = max(interior_err[name], diff[edge:-edge].max())
+            edge_err[name] = max(edge_err[name], diff[:edge].max(), diff[-edge:].max())
+
+    row_format = "{:>16}" + "{:>16}" * 3
+    print(row_format.format('Matrix', 'Edge frames', 'Interior diff', 'Edge diff'))
+    ok = True
+    for name in sorted(EDGE):
+        print(row_format.format(name, 2 * EDGE[name], '{:.2e}'.format(interior_err[name]),
+                                '{:.2e}'.format(edge_err[name])))
+        ok = ok and interior_err[name] <= TOLERANCE[name]
+
+    ### The network inputs, stacked by each Feature class, differ in the same frames
+    mc = 60 + np.sin(np.arange(pm.MC_LENGTH) / 3.)
+    edge = max(EDGE.values())
+    for m_class in (MFCCFeature, SpecFeature, CocktailFeature):
+        err = 0.
+        for start_i in starts:
+            clip_ft = m_class.extract_features(song_feat.clip(start_i, N_BIN), mc, 'clip')[0]
+            song_ft = m_class.extract_song_features(song_feat, start_i, N_BIN, mc, 'clip')[0]
+            assert clip_ft.shape == song_ft.shape, (m_class.__name__, clip_ft.shape, song_ft.shape)
+            err = max(err, relative_diff(song_ft, clip_ft)[edge:-edge].max())
+        print(row_format.format(m_class.__name__, 2 * edge, '{:.2e}'.format(err), '-'))
+        ok = ok and err <= max(TOLERANCE.values())
+    return ok
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        audio, _ = rosa.load(sys.argv[1], sr=pm.SAMPLING_RATE, mono=True)
+    else:
+        audio = synth_audio()
+    ok = check(audio)
+    print('PASSED' if ok else 'FAILED: interior frames differ by more than the tolerance')
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,65 @@
+"""
+--------------------------------------------------------------------------------
+Check that TentTracker gives the notes, segments (including seg.diff()) and
+next_note links of tent() when the melody is pushed in blocks, and that it keeps
+a bounded number of frames
+--------------------------------------------------------------------------------
+Usage: python checks/check_tent_streaming.py [FilteredMelody.txt ...]
+"""
+import os, sys, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+from guitar_trans.te_note_tracking import tent, TentTracker
+from guitar_trans.contour import Contour
+
+def synth_melody(seed, n_notes=400):
+    ### Notes with bends, vibratos, glides and rests, in MIDI numbers
+    rs = np.random.RandomState(seed)
+    out, p = [], 60
+    for _ in range(n_notes):
+        L = rs.randint(5, 120)
+        t = np.arange(L)
+        x = np.full(L, float(p))
+        kind = rs.randint(6)
+        if kind == 1: x += np.clip((t - L / 3.) / 10., 0, 1) * rs.choice([1, 2])
+        elif kind == 2: x += 0.6 * np.sin(t * 0.6) * (t > L / 4)
+        elif kind == 3: x += np.linspace(0, rs.choice([-5, 5]), L)
+        elif kind == 4: x[:] = 0
+        out.append(np.round(x + rs.randn(L) * 0.05, 3))
+        p = int(np.clip(p + rs.randint(-4, 5), 45, 80))
+    return np.concatenate(out)
+
+def summary(notes):
+    return [(n.array_repr().tolist(),
+             [(s.val, s.pos, s.length, s.diff()) for s in n.segs],
+             None if n.next_note is None else n.next_note.array_repr().tolist()) for n in notes]
+
+def check(name, mc, n_trials=5):
+    _, _, batch_notes = tent(Contour(0, mc))
+    expected = summary(batch_notes)
+    ok = True
+    for trial in range(n_trials):
+        blocks, i = [], 0
+        while i < len(mc):
+            n = random.choice([1, 3, 7, 50, 100, 300])
+            blocks.append(mc[i:i + n])
+            i += n
+        tracker = TentTracker()
+        notes, max_kept = [], 0
+        for block in blocks:
+            notes += [nt for nt, cands in tracker.push(block)]
+            max_kept = max(max_kept, len(tracker.melo) + len(tracker.raw))
+        notes += [nt for nt, cands in tracker.flush()]
+        same = summary(notes) == expected
+        ok = ok and same
+        print('{} trial {}: {} notes, {} segs, same as tent(): {}, most frames kept: {} of {}'.format(
+              name, trial, len(notes), sum(len(n.segs) for n in notes), same, max_kept, len(mc)))
+    return ok
+
+if __name__ == '__main__':
+    random.seed(0)
+    melodies = [(fp, np.loadtxt(fp)) for fp in sys.argv[1:]] or \
+               [('synthetic {}'.format(seed), synth_melody(seed)) for seed in (1, 2, 3)]
+    results = [check(name, mc) for name, mc in melodies]
+    print('PASSED' if all(results) else 'FAILED')
+    sys.exit(0 if all(results) else 1)
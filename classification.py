@@ -6,6 +6,10 @@ Script for training guitar playing technique classification models
 --------------------------------------------------------------------------------
 """
 import glob, os, sys, fnmatch, time, random, csv
+if __name__ == '__main__':
+    ### Before numpy and Theano load BLAS
+    from blas_threads import set_blas_threads
+    set_blas_threads(sys.argv[1:])
 import numpy as np
 import librosa as rosa
 import theano
@@ -14,25 +18,17 @@ import lasagne
 import pprint
 from guitar_trans import models
 from guitar_trans import parameters as pm
+from guitar_trans.features import replace_leading_ending_zeros, fit_melody_window
 from lasagne import layers
 from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_score
 
 model_dir = "model"
 output_dir = "outputs"
+### Epochs without a lower validation loss before a fold stops training
+patience = 10
 
 #=====LOAD AND PREPROCESS INPUT FEATURES=====#
 
-def replace_leading_ending_zeros(array):
-    for idx, a in enumerate(array):
-        if a > 0:
-            array[:idx] = array[idx]
-            break
-    for idx, a in enumerate(reversed(array)):
-        if a > 0:
-            i = len(array)-1-idx
-            array[i:] = array[i]
-            break
-
 def save_to_feature_bank(bank, feature, num):
     num = int(num)
     for idx, cv in enumerate(pm.cv_list):
@@ -72,11 +68,7 @@ def load_n_preprocess_input_feature(audio_dir, mc_dir, m_class, sep_direction=Fa
                 if len(mc) < 18:
                     print('{} mc length must be larger than 18. (only {}).'.format(fi, len(mc)))
                     continue
-                elif len(mc) < pm.MC_LENGTH:
-                    mc = np.pad(mc, (0, pm.MC_LENGTH-len(mc)), 'edge')
-                elif len(mc) > pm.MC_LENGTH:
-                    mc = mc[:pm.MC_LENGTH]
-                replace_leading_ending_zeros(mc)
+                mc = fit_melody_window(mc)
                 
                 ### Classify ascending or descending
                 if sep_direction:
@@ -136,48 +128,114 @@ def get_train_test_feat(feature_bank, idx, balance=False):
 
 #=====CLASSIFICATION=====#
 
-def classify(feature_bank, model_name, model_class, param_set, sep_direction=True, test_aug=False):
-    if not os.path.isdir(os.path.join(model_dir, model_name)):
-        os.mkdir(os.path.join(model_dir, model_name))
-    if not os.path.isdir(os.path.join(output_dir, model_name)):
-        os.mkdir(os.path.join(output_dir, model_name))
+### Feature bank of the running classify(), inherited by forked fold workers instead of pickled
+_feature_bank = None
+
+def init_fold_worker():
+    ### Forked workers start from the parent's random state
+    np.random.seed()
+    random.seed()
+
+def train_fold(job):
+    key, idx, model_name, model_class, param_set, sep_direction, test_aug, resume, run_model_dir = job
+    direction_type = key if sep_direction else pm.D_MIXED
+    print('Training {} {}s, fold {}...'.format(model_name, direction_type, idx))
+    bank = _feature_bank[key]
+    model_file = model_name+'_'+str(idx)+'.'+direction_type+'.npz'
+    model_fp = os.path.join(run_model_dir, model_name, model_file)
+    train_list, test_list = get_train_test_feat(bank, idx, balance=False)
+
+    ### initialize model
+    model = model_class(param_set, model_fp)
+
+    ### train model and save training result (a resumed run keeps the folds it has finished)
+    if not (resume and os.path.exists(model_fp)):
+        model.train(train_list, 100, patience=patience, resume=resume)
+
+    ### test and evaluate
+    npzfile = np.load(model_fp)
+    model.set_param_values(npzfile['params'])
+    if test_aug:
+        cm = model.test(test_list)
+    else:
+        origin_test_list = []
+        for t in test_list:
+            if 'aug' not in t[-1]:
+                origin_test_list.append(t)
+        cm = model.test(origin_test_list)
+    return model_name, key, cm
+
+def fold_jobs(feature_bank, model_name, model_class, param_set, sep_direction=True, test_aug=False, 
+              resume=False, run_model_dir=None, run_output_dir=None):
+    ### One job per (direction, fold); the directories default to model_dir and output_dir
+    run_model_dir = run_model_dir or model_dir
+    run_output_dir = run_output_dir or output_dir
+    if not os.path.isdir(os.path.join(run_model_dir, model_name)):
+        os.makedirs(os.path.join(run_model_dir, model_name))
+    if not os.path.isdir(os.path.join(run_output_dir, model_name)):
+        os.makedirs(os.path.join(run_output_dir, model_name))
+    return [(key, idx, model_name, model_class, param_set, sep_direction, test_aug, resume, run_model_dir) 
+            for key in feature_bank for idx in range(len(feature_bank[key]))]
+
+def run_fold_jobs(feature_bank, jobs, n_jobs=1):
+    """
+    Run train_fold() on jobs, in order in this process if n_jobs is 1,
+    otherwise in forked worker processes (None for all CPUs) that share
+    feature_bank. Workers use the BLAS threads this process was started
+    with (see blas_threads.py).
+    """
+    global _feature_bank
+    _feature_bank = feature_bank
+    try:
+        if n_jobs == 1:
+            return map(train_fold, jobs)
+        from multiprocessing import Pool, cpu_count
+        n_jobs = min(n_jobs or cpu_count(), len(jobs))
+        blas_threads = os.environ.get('OPENBLAS_NUM_THREADS', cpu_count())
+        print('Training {} folds in {} processes ({} BLAS threads each)...'.format(len(jobs), n_jobs, blas_threads))
+        pool = Pool(n_jobs, initializer=init_fold_worker, maxtasksperchild=1)
+        try:
+            return pool.map(train_fold, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _feature_bank = None
+
+def collect_fold_results(fold_results, keys, model_name, sep_direction=True, run_output_dir=None):
+    ### Sum the confusion matrices of the folds of model_name per direction and save the scores
+    run_output_dir = run_output_dir or output_dir
     all_results = {}
-    for key in feature_bank:
+    for key in keys:
         direction_type = key if sep_direction else pm.D_MIXED
-        print('Training {}s...'.format(direction_type))
-        bank = feature_bank[key]
         cm_all = np.zeros((pm.NUM_CLASS, pm.NUM_CLASS), dtype=int)
-        for idx in range(len(bank)):
-            model_file = model_name+'_'+str(idx)+'.'+direction_type+'.npz'
-            model_fp = os.path.join(model_dir, model_name, model_file)
-            train_list, test_list = get_train_test_feat(bank, idx, balance=False)
-
-            ### initialize model
-            model = model_class(param_set, model_fp)
-
-            ### train model and save training result
-            model.train(train_list, 100)
-
-            ### test and evaluate
-            npzfile = np.load(model_fp)
-            model.set_param_values(npzfile['params'])
-            if test_aug:
-                cm = model.test(test_list)
-            else:
-                origin_test_list = []
-                for t in test_list:
-                    if 'aug' not in t[-1]:
-                        origin_test_list.append(t)
-                cm = model.test(origin_test_list)
-            cm_all += cm
+        for name, k, cm in fold_results:
+            if name == model_name and k == key:
+                cm_all += cm
         
         
         csv_fn = 'evaluation.' + direction_type + '.csv'
-        save_fp = os.path.join(output_dir, model_name, csv_fn)
+        save_fp = os.path.join(run_output_dir, model_name, csv_fn)
         eval_scores(cm_all, key, print_scores=True, save_fp=save_fp)
         all_results[key] = cm_all
     return all_results
 
+def classify(feature_bank, model_name, model_class, param_set, sep_direction=True, test_aug=False, 
+             n_jobs=1, resume=False, run_model_dir=None, run_output_dir=None):
+    """
+    Train and test one model per cross validation fold and direction.
+    With n_jobs > 1 (None for all CPUs), each (direction, fold) pair is
+    trained in its own forked process, with the BLAS threads of the
+    machine split between the workers. With resume=True, folds continue
+    from the checkpoints of an interrupted run. Models and scores go
+    under run_model_dir and run_output_dir (model_dir and output_dir by
+    default).
+    """
+    jobs = fold_jobs(feature_bank, model_name, model_class, param_set, sep_direction, test_aug, 
+                     resume, run_model_dir, run_output_dir)
+    fold_results = run_fold_jobs(feature_bank, jobs, n_jobs)
+    return collect_fold_results(fold_results, feature_bank.keys(), model_name, sep_direction, run_output_dir)
+
 #=====EVALUATION=====#
 
 def eval_scores(cm, direction_type, print_scores=True, save_fp=None):
@@ -229,7 +287,7 @@ def eval_scores(cm, direction_type, print_scores=True, save_fp=None):
 
 #=====MAIN FUNCTION=====#
 
-def main(model_name, model_type, model_opts, data_dir, sep_direction=True, test_aug=False, description=None):
+def main(model_name, model_type, model_opts, data_dir, sep_direction=True, test_aug=False, description=None, n_jobs=1, resume=False):
     if description is not None:
         print('Description: {}'.format(description))
     audio_dir = os.path.join(data_dir, 'audio')
@@ -240,7 +298,7 @@ def main(model_name, model_type, model_opts, data_dir, sep_direction=True, test_
     # feature_bank = load_n_preprocess_input_feature(audio_dir, mc_dir, model_class, sep_direction)
     # np.save('feature_bank_mfcc.npy', feature_bank)
     feature_bank = np.load('feature_bank_mfcc.npy').item()
-    all_results = classify(feature_bank, model_name, model_class, param_set, sep_direction=True, test_aug=False)
+    all_results = classify(feature_bank, model_name, model_class, param_set, sep_direction=True, test_aug=False, n_jobs=n_jobs, resume=resume)
     return all_results
 
 
@@ -265,9 +323,13 @@ Script for training guitar playing technique classification models.
                     help='The directory of the dataset to be used.')
     p.add_argument('-d', '--description', type=str, 
                     help='The description of this model.')
+    p.add_argument('-j', '--n_jobs', type=int, default=1,
+                    help='The number of processes training folds in parallel (0 for all CPUs).')
+    p.add_argument('--resume', action='store_true',
+                    help='Continue the interrupted training of this model from its checkpoints.')
     return p.parse_args()
 
 if __name__ == '__main__':
     args = parser()
-    main(args.model_name, args.model_type, args.model_opts, args.data_dir, description=args.description)
+    main(args.model_name, args.model_type, args.model_opts, args.data_dir, description=args.description, n_jobs=args.n_jobs or None, resume=args.resume)
 
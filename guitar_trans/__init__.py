@@ -1,7 +1,9 @@
 from . import contour
 from . import evaluation
-from . import models
+from . import features
+from . import gating
 from . import note
+from . import np_models
 from . import parameters
 from . import song
 from . import te_note_tracking
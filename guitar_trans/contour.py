@@ -1,10 +1,107 @@
 import numpy as np
-from itertools import groupby
+
+class RangeIndex(object):
+    """
+    Sparse tables of the maxima and minima of a sequence over ranges of
+    2^k values, so that the max and min of any range are found in O(1).
+    """
+    def __init__(self, seq=None, tables=None):
+        if tables is None:
+            seq = np.asarray(seq, dtype=float)
+            tables = ([seq], [seq])
+            k = 1
+            while 2 * k <= len(seq):
+                mx, mn = tables[0][-1], tables[1][-1]
+                tables[0].append(np.maximum(mx[:-k], mx[k:]))
+                tables[1].append(np.minimum(mn[:-k], mn[k:]))
+                k *= 2
+        self.max_tables, self.min_tables = tables
+
+    def __len__(self):
+        return len(self.max_tables[0])
+
+    def __level(self, start, end):
+        if end <= start:
+            raise ValueError('Empty range [{}, {}).'.format(start, end))
+        k = int(end - start).bit_length() - 1
+        return k, end - (1 << k)
+
+    def max(self, start, end):
+        k, j = self.__level(start, end)
+        return max(self.max_tables[k][start], self.max_tables[k][j])
+
+    def min(self, start, end):
+        k, j = self.__level(start, end)
+        return min(self.min_tables[k][start], self.min_tables[k][j])
+
+    def sub(self, start, end):
+        """
+        RangeIndex of seq[start:end], copied from the tables of this one.
+        """
+        length = end - start
+        n_level = max(length, 1).bit_length()
+        return RangeIndex(tables=([t[start:start + length - (1 << k) + 1].copy()
+                                   for k, t in enumerate(self.max_tables[:n_level])],
+                                  [t[start:start + length - (1 << k) + 1].copy()
+                                   for k, t in enumerate(self.min_tables[:n_level])]))
 
 class Contour(object):
-    def __init__(self, start_idx=0, seq=np.array([])):
+    """
+    Sequence starting at start_idx. With copy=False, seq is used without
+    copying and may be shared with its owner, e.g. as a view made by
+    view(). A shared sequence is read-only and copied on the first write
+    or append. append() grows an amortized buffer.
+
+    After build_range_index(), the contour and its views answer max, min
+    and range_max()/range_min() in O(1) from one RangeIndex. range_index
+    is the (RangeIndex, offset of seq[0] in it) pair, or None.
+    """
+    def __init__(self, start_idx=0, seq=np.array([]), copy=True, range_index=None):
         self.start_idx = int(start_idx)
-        self.seq = np.array(seq).copy()
+        self.__set_buf(np.array(seq, copy=copy), shared=not copy)
+        self.__rindex = range_index
+
+    def __set_buf(self, buf, shared, length=None):
+        self.__buf = buf
+        self.__len = len(buf) if length is None else length
+        self.__shared = shared
+        self.__seq = buf[:self.__len]
+        if shared: self.__seq.flags.writeable = False
+
+    def __unshare(self, length):
+        self.__rindex = None
+        if self.__shared or length > len(self.__buf):
+            buf = np.empty(max(length, 2 * len(self.__buf)), dtype=self.__buf.dtype)
+            buf[:self.__len] = self.__seq
+            self.__set_buf(buf, shared=False, length=self.__len)
+
+    def __getstate__(self):
+        ### Pickle only the sequence, not the buffer it is a view of
+        state = self.__dict__.copy()
+        seq = np.array(self.__seq)
+        state['_Contour__buf'] = state['_Contour__seq'] = seq
+        state['_Contour__shared'] = False
+        if self.__rindex is not None:
+            rindex, offset = self.__rindex
+            state['_Contour__rindex'] = (rindex.sub(offset, offset + self.__len), 0)
+        return state
+
+    def seq():
+        doc = "The seq property."
+        def fget(self):
+            return self.__seq
+        def fset(self, value):
+            self.__set_buf(np.array(value), shared=False)
+            self.__rindex = None
+        return locals()
+    seq = property(**seq())
+
+    @property
+    def range_index(self):
+        return self.__rindex
+
+    def build_range_index(self):
+        self.__rindex = (RangeIndex(self.__seq), 0)
 
     def __repr__(self):
         return 'start_idx: ' + str(self.start_idx) + '\nseq: ' + repr(self.seq)
@@ -13,7 +110,11 @@ class Contour(object):
         return 'start_idx: ' + str(self.start_idx) + '\nseq: ' + repr(self.seq)
 
     def __getitem__(self, arg):
-        return self.seq[arg]
+        return self.__seq[arg]
+
+    def __setitem__(self, arg, val):
+        self.__unshare(self.__len)
+        self.__seq[arg] = val
 
     @property
     def length(self):
@@ -25,18 +126,57 @@ class Contour(object):
 
     @property
     def max(self):
-        return np.max(self.seq)
+        return self.range_max(0, self.__len)
 
     @property
     def min(self):
-        return np.min(self.seq)
+        return self.range_min(0, self.__len)
+
+    def range_max(self, start, end):
+        """
+        Maximum of seq[start:end].
+        """
+        end = min(end, self.__len)
+        if self.__rindex is None:
+            return np.max(self.__seq[start:end])
+        rindex, offset = self.__rindex
+        return rindex.max(offset + start, offset + end)
+
+    def range_min(self, start, end):
+        """
+        Minimum of seq[start:end].
+        """
+        end = min(end, self.__len)
+        if self.__rindex is None:
+            return np.min(self.__seq[start:end])
+        rindex, offset = self.__rindex
+        return rindex.min(offset + start, offset + end)
 
     def estimated_pitch(self, indices=None):
         x = self.seq[indices] if indices else self.seq
         return int(round(x.mean()))
 
     def append(self, val):
-        self.seq = np.append(self.seq, val)
+        val = np.ravel(val)
+        ### Only a wider type needs a new buffer; narrower values are cast on the write below
+        dtype = np.result_type(self.__buf, val)
+        if dtype != self.__buf.dtype:
+            self.__set_buf(self.__seq.astype(dtype), shared=False)
+        length = self.__len + len(val)
+        self.__unshare(length)
+        self.__buf[self.__len:length] = val
+        self.__set_buf(self.__buf, shared=False, length=length)
+
+    def view(self, start, end):
+        """
+        Contour of seq[start:end] sharing the sequence with this contour.
+        """
+        self.__shared = True
+        self.__seq.flags.writeable = False
+        rindex = None
+        if self.__rindex is not None:
+            rindex = (self.__rindex[0], self.__rindex[1] + start)
+        return Contour(self.start_idx + start, self.__seq[start:end], copy=False, range_index=rindex)
 
     def sub_contour(self, indices):
         if len(indices) == 0: return None
@@ -44,6 +184,8 @@ class Contour(object):
         return type(self)(idx, self.seq[indices])
 
 class Segment(object):
+    __slots__ = ('val', 'pos', 'length', 'ref_con')
+
     def __init__(self, val=0, pos=0, length=0, ref_con=None, seg=None):
         if seg is not None:
             self.val = seg.val # value
@@ -70,64 +212,179 @@ class Segment(object):
         return self.pos + int((self.length + 1) / 2)
 
     def diff(self):
-        ct = Contour(self.ref_con.start_idx+self.pos, 
-                     self.ref_con.seq[self.pos:self.pos+self.length+1])
-        return ct.max - ct.min
+        end = self.pos + self.length + 1
+        return self.ref_con.range_max(self.pos, end) - self.ref_con.range_min(self.pos, end)
 
     def contour(self):
-        return Contour(self.ref_con.start_idx+self.pos, 
-                       self.ref_con.seq[self.pos:self.pos+self.length])
+        return self.ref_con.view(self.pos, self.pos+self.length)
+
+class SegmentView(Segment):
+    """
+    Segment stored in a SegmentedContour. Its value and length are read from
+    and written to the arrays of the contour. When the segment is deleted
+    from the contour, it keeps its last value and length as a plain Segment.
+    """
+    __slots__ = ('__con', '__pos', '__fields')
+
+    def __init__(self, seg_con, pos):
+        self.__con = seg_con
+        self.__pos = pos
+        self.ref_con = seg_con
+
+    def __getstate__(self):
+        return (self.__con, self.__pos, getattr(self, '_SegmentView__fields', None), self.ref_con)
+
+    def __setstate__(self, state):
+        self.__con, self.__pos, fields, self.ref_con = state
+        if fields is not None: self.__fields = fields
+
+    def _detach(self):
+        self.__fields = (self.val, self.length)
+        self.__con = None
+
+    @property
+    def pos(self):
+        return self.__pos
+
+    def val():
+        doc = "The val property."
+        def fget(self):
+            if self.__con is None: return self.__fields[0]
+            return self.__con._seg_field(self.__pos, 'val')
+        def fset(self, value):
+            if self.__con is None: self.__fields = (value, self.__fields[1])
+            else: self.__con._set_seg_field(self.__pos, 'val', value)
+        return locals()
+    val = property(**val())
+
+    def length():
+        doc = "The length property."
+        def fget(self):
+            if self.__con is None: return self.__fields[1]
+            return int(self.__con._seg_field(self.__pos, 'length'))
+        def fset(self, value):
+            if self.__con is None: self.__fields = (self.__fields[0], value)
+            else: self.__con._set_seg_field(self.__pos, 'length', value)
+        return locals()
+    length = property(**length())
+
+SEG_DTYPE = [('pos', int), ('length', int), ('val', float)]
 
 class SegmentedContour(Contour):
-    def __init__(self, start_idx, seq, trend=[]):
-        super(SegmentedContour, self).__init__(start_idx, seq)
-        self.__seg_dict = {}
+    """
+    Contour with the segments of its trend, stored as a structured array of
+    (pos, length, val) sorted by pos. The trend is cached until a segment
+    changes.
+    """
+    def __init__(self, start_idx, seq, trend=[], copy=True, range_index=None):
+        super(SegmentedContour, self).__init__(start_idx, seq, copy, range_index)
+        trend = np.asarray(trend[:len(self.seq)], dtype=float)
         if len(trend) > 0:
-            p = 0
-            for val, _s in groupby(trend[:len(self.seq)]):
-                length = len(list(_s))
-                if val != 0:
-                    self.__seg_dict[p] = Segment(val, p, length, self)
-                p += length
+            bounds = np.flatnonzero(np.r_[True, trend[1:] != trend[:-1], True])
+            pos = bounds[:-1]
+            nonzero = trend[pos] != 0
+            self.__segs = np.zeros(np.count_nonzero(nonzero), dtype=SEG_DTYPE)
+            self.__segs['pos'] = pos[nonzero]
+            self.__segs['length'] = np.diff(bounds)[nonzero]
+            self.__segs['val'] = trend[pos][nonzero]
+        else:
+            self.__segs = np.zeros(0, dtype=SEG_DTYPE)
+        self.__views = {}
+        self.__trend = None
+
+    def __index(self, keys):
+        pos = self.__segs['pos']
+        idx = np.searchsorted(pos, keys)
+        if np.any(idx >= len(pos)) or np.any(pos[np.minimum(idx, len(pos)-1)] != keys):
+            raise KeyError(keys)
+        return idx
+
+    def _seg_field(self, key, name):
+        return self.__segs[name][self.__index(key)]
+
+    def _set_seg_field(self, key, name, value):
+        self.__segs[name][self.__index(key)] = value
+        self.__trend = None
 
     def seg(self, key):
-        return self.__seg_dict[key]
+        key = int(key)
+        if key not in self.__views:
+            self.__index(key)
+            self.__views[key] = SegmentView(self, key)
+        return self.__views[key]
 
     def all_segs(self, sort=False):
-        if sort:
-            return sorted(self.__seg_dict.values(), key=lambda x: x.pos)
-        else:
-            return self.__seg_dict.values()
+        ### Segments are always sorted by position
+        return [self.seg(p) for p in self.__segs['pos']]
     
     def seg_keys(self):
-        return self.__seg_dict.keys()
+        return self.__segs['pos'].tolist()
 
     @property
     def n_segs(self):
-        return len(self.__seg_dict)
+        return len(self.__segs)
 
     def merge_segs(self, keys):
         if len(keys) > 1:
             keys.sort()
-            s = self.seg(keys[0])
-            s.length = self.seg(keys[-1]).end - s.pos
-            for i in keys[1:]:
-                self.delete_seg(i)
+            idx = self.__index(keys)
+            self.__segs['length'][idx[0]] = self.__segs['pos'][idx[-1]] + \
+                self.__segs['length'][idx[-1]] - self.__segs['pos'][idx[0]]
+            self.__drop(idx[1:])
+
+    def merge_close_segs(self, max_gap):
+        """
+        Merge each run of adjacent segments of the same value where the gap
+        between two neighbours is smaller than max_gap.
+        """
+        if len(self.__segs) < 2: return
+        segs = self.__segs
+        ends = segs['pos'] + segs['length']
+        join = (segs['val'][1:] == segs['val'][:-1]) & (segs['pos'][1:] - ends[:-1] < max_gap)
+        first = np.flatnonzero(np.r_[True, ~join])
+        last = np.r_[first[1:] - 1, len(segs) - 1]
+        segs['length'][first] = ends[last] - segs['pos'][first]
+        self.__drop(np.flatnonzero(np.r_[False, join]))
 
     def delete_seg(self, key):
         if isinstance(key, Segment):
-            self.__seg_dict.pop(key.pos)
-        else:
-            self.__seg_dict.pop(key)
+            key = key.pos
+        self.__drop(self.__index([key]))
+
+    def delete_segs(self, keys):
+        keys = [k.pos if isinstance(k, Segment) else k for k in keys]
+        self.__drop(self.__index(keys))
+
+    def __drop(self, idx):
+        if len(idx) == 0: return
+        for p in self.__segs['pos'][idx]:
+            view = self.__views.pop(p, None)
+            if view is not None: view._detach()
+        self.__segs = np.delete(self.__segs, idx)
+        self.__trend = None
 
     def get_trend(self):
-        trend = np.zeros(self.length)
-        for s in self.all_segs():
-            trend[s.pos:s.pos+s.length] = s.val
-        return trend
+        if self.__trend is None:
+            segs = self.__segs
+            trend = np.zeros(self.length)
+            seg_idx = np.repeat(np.arange(len(segs)), segs['length'])
+            frame = np.arange(len(seg_idx)) - np.repeat(np.cumsum(segs['length']) - segs['length'], segs['length'])
+            frame += segs['pos'][seg_idx]
+            inside = frame < self.length
+            trend[frame[inside]] = segs['val'][seg_idx[inside]]
+            trend.flags.writeable = False
+            self.__trend = trend
+        return self.__trend
 
     def sub_contour(self, indices):
         if len(indices) == 0: return None
         idx = self.start_idx + indices[0]
         return type(self)(idx, self.seq[indices], self.get_trend()[indices])
 
+    def sub_view(self, start, end):
+        """
+        SegmentedContour of seq[start:end] sharing the sequence with this one.
+        """
+        ct = self.view(start, end)
+        return type(self)(ct.start_idx, ct.seq, self.get_trend()[start:end],
+                          copy=False, range_index=ct.range_index)
@@ -49,7 +49,7 @@ expression_style_note:  Text file of array, storing the onset, offset
 from mir_eval.transcription import precision_recall_f1_overlap
 from mir_eval.onset import f_measure
 from technique import *
-from note import Note
+from note import Note, NoteTable
 import numpy as np
 import os, sys, csv
 
@@ -59,9 +59,9 @@ def fit_mir_eval_transcription(ans_list, pred_list):
 
     Parameters
     ----------
-    ans_list: np.ndarray, shape=(n_event, 3)
+    ans_list: NoteTable or list of Note
         Answer of note events.
-    pred_list: np.ndarray, shape=(n_event, 3)
+    pred_list: NoteTable or list of Note
         Prediction of note events.
     
     Returns
@@ -71,10 +71,11 @@ def fit_mir_eval_transcription(ans_list, pred_list):
     est_intervals: np.ndarray, shape=(n_event, 2)
     est_pitches:   np.ndarray, shape=(n_event,)
     """
-    ref_intervals = np.array([[esn.onset, esn.offset] for esn in ans_list])
-    ref_pitches = np.array([esn.pitch for esn in ans_list])
-    est_intervals = np.array([[esn.onset, esn.offset] for esn in pred_list])
-    est_pitches = np.array([esn.pitch for esn in pred_list])
+    ans, pred = NoteTable.from_notes(ans_list), NoteTable.from_notes(pred_list)
+    ref_intervals = ans.intervals
+    ref_pitches = ans.pitch.copy()
+    est_intervals = pred.intervals
+    est_pitches = pred.pitch.copy()
     return ref_intervals, ref_pitches, est_intervals, est_pitches
 
 def calculate_candidate_cls_accuracy_f_measure(annotation_ts_pseudo, candidate_result_pseudo, tech_index_dic):
@@ -176,43 +177,44 @@ def calculate_ts_f_measure(annotation_ts, prediction_ts, tech):
     return P, R, F, TP, FP, FN
 
 def calculate_esn_f_measure(ans_list, pred_list, tech, onset_tolerance=0.1, offset_ratio=None, correct_pitch=True):
+    ans_tab, pred_tab = NoteTable.from_notes(ans_list), NoteTable.from_notes(pred_list)
+    ans_arr, pred_arr = ans_tab.arr, pred_tab.arr
+    if tech in [T_PULL, T_HAMMER, T_SLIDE]:
+        ans_has, pred_has = ans_tab.has_tech(tech, [1,3]), pred_tab.has_tech(tech, [1,3])
+    elif tech is not None:
+        ans_has, pred_has = ans_tab.has_tech(tech), pred_tab.has_tech(tech)
+
     def check_condition(a_i, p_i):
-        ans, pred = ans_list[a_i], pred_list[p_i]
+        ans, pred = ans_arr[a_i], pred_arr[p_i]
         # Check onset correctness
-        if pred.onset < ans.onset - onset_tolerance: return False, a_i, p_i + 1
-        if pred.onset > ans.onset + onset_tolerance: return False, a_i + 1, p_i
+        if pred[1] < ans[1] - onset_tolerance: return False, a_i, p_i + 1
+        if pred[1] > ans[1] + onset_tolerance: return False, a_i + 1, p_i
         # Check tech correctness
-        if tech in [T_PULL, T_HAMMER, T_SLIDE]:
-            tech_cond = ans.tech(tech).value in [1,3] and pred.tech(tech).value in [1,3]
+        if tech is None:
+            tech_cond = (ans[3:] == pred[3:]).all()
         else:
-            tech_cond = ans.equal_tech(pred) if tech is None else (ans.tech(tech).value > 0 and pred.tech(tech).value > 0)
+            tech_cond = ans_has[a_i] and pred_has[p_i]
         if not tech_cond:
-            (a_i, p_i) = (a_i, p_i + 1) if pred.onset < ans.onset else (a_i + 1, p_i)
+            (a_i, p_i) = (a_i, p_i + 1) if pred[1] < ans[1] else (a_i + 1, p_i)
             return False, a_i, p_i
         # Check pitch and offset correctness if needed
-        correct_pitch_cond = (ans.pitch == pred.pitch) if correct_pitch == True else True
-        offset_ratio_cond = (ans.offset - ans.duration*offset_ratio < pred.offset < ans.offset + ans.duration*offset_ratio) \
+        correct_pitch_cond = (ans[0] == pred[0]) if correct_pitch == True else True
+        ans_offset, pred_offset = ans[1] + ans[2], pred[1] + pred[2]
+        offset_ratio_cond = (ans_offset - ans[2]*offset_ratio < pred_offset < ans_offset + ans[2]*offset_ratio) \
                             if offset_ratio is not None else True
         if correct_pitch_cond and offset_ratio_cond: return True, a_i+1, p_i+1
         else: 
-            (a_i, p_i) = (a_i, p_i + 1) if pred.onset < ans.onset else (a_i + 1, p_i)
+            (a_i, p_i) = (a_i, p_i + 1) if pred[1] < ans[1] else (a_i + 1, p_i)
             return False, a_i, p_i
 
-    def count_tech_in_list(esn_list, tch):
-        idx, ct = 0, 0
-        while idx < len(esn_list):
-            esn = esn_list[idx]
-            if tch in [T_PULL, T_HAMMER, T_SLIDE]:
-                if esn.tech(tch).value in [1, 3]:
-                    ct += 1
-            elif esn.tech(tch).value > 0:
-                ct += 1
-            idx += 1
-        return ct
+    def count_tech_in_list(esn_tab, tch):
+        if tch in [T_PULL, T_HAMMER, T_SLIDE]:
+            return int(esn_tab.has_tech(tch, [1, 3]).sum())
+        return int(esn_tab.has_tech(tch).sum())
 
     TP, FP, FN = 0, 0, 0
     a_i, p_i = 0, 0
-    while a_i < len(ans_list) and p_i < len(pred_list):
+    while a_i < len(ans_arr) and p_i < len(pred_arr):
         correct, a_i, p_i = check_condition(a_i, p_i)
         # if correct and tech in [T_PULL, T_HAMMER, T_SLIDE] and \
         #    a_i + 1 < len(ans_list) and p_i + 1 < len(pred_list):
@@ -222,8 +224,8 @@ def calculate_esn_f_measure(ans_list, pred_list, tech, onset_tolerance=0.1, offs
     tch_list = range(T_PREBEND, T_NORMAL) if tech is None else [tech]
     n_pred_techs, n_ans_techs = 0, 0
     for tch in tch_list:
-        n_pred_techs += count_tech_in_list(pred_list, tch)
-        n_ans_techs += count_tech_in_list(ans_list, tch)
+        n_pred_techs += count_tech_in_list(pred_tab, tch)
+        n_ans_techs += count_tech_in_list(ans_tab, tch)
     FP = n_pred_techs - TP
     FN = n_ans_techs - TP
 
@@ -318,28 +320,12 @@ def evaluation_candidate_cls(annotation_ts_orig, candidate_result_orig, output_d
     sys.stdout = save_stdout
     fh.close()
 
-def remove_poly_notes(notes, poly_mask):
-    notes_poly_removed = notes.copy()
-    note_to_be_deleted = []
-    for index_n, note in enumerate(notes):
-        onset = note[1]
-        offset = note[1]+note[2]
-        for index_p, poly_note in enumerate(poly_mask):
-            onset_in = poly_note[0] < onset < poly_note[1]
-            offset_in = poly_note[0] < offset < poly_note[1]
-            if onset_in or offset_in:
-                note_to_be_deleted.append(index_n)
-    notes_poly_removed = np.delete(notes_poly_removed, note_to_be_deleted, axis=0)
-    return notes_poly_removed
-
 def eval_note_from_files(ans_fp, pred_fp, output_dir, filename, 
                     onset_tolerance=0.1, offset_ratio=0.2, 
                     string=None, mode='w', verbose=False, 
                     separator=' ', poly_mask=None, extension=''):
-    ans = np.loadtxt(ans_fp)
-    ans_list = np.array([Note(nt[0], nt[1], nt[2]) for nt in ans])
-    pred = np.loadtxt(pred_fp)
-    pred_list = np.array([Note(nt[0], nt[1], nt[2]) for nt in pred])
+    ans_list = NoteTable.load(ans_fp, techs=False)
+    pred_list = NoteTable.load(pred_fp, techs=False)
     evaluation_note(ans_list, pred_list, output_dir, filename, 
                     onset_tolerance, offset_ratio, 
                     string, mode, verbose, 
@@ -351,8 +337,8 @@ def evaluation_note(ans_list, pred_list, output_dir, filename,
                     separator=' ', poly_mask=None, extension=''):
     if poly_mask:
         poly_mask = np.loadtxt(poly_mask)
-        ans_list = remove_poly_notes(ans_list, poly_mask)
-        pred_list = remove_poly_notes(pred_list, poly_mask)
+        ans_list = remove_poly_esn(ans_list, poly_mask)
+        pred_list = remove_poly_esn(pred_list, poly_mask)
     ref_intervals, ref_pitches, est_intervals, est_pitches = fit_mir_eval_transcription(ans_list, pred_list)
     result = []
 
@@ -385,27 +371,18 @@ def evaluation_note(ans_list, pred_list, output_dir, filename,
     print result
 
 def remove_poly_esn(esn_list, poly_mask):
-    esn_poly_removed = esn_list.copy()
-    esn_to_be_deleted = []
-    for index_n, esn in enumerate(esn_list):
-        onset = esn.onset
-        offset = esn.offset
-        for index_p, poly_note in enumerate(poly_mask):
-            onset_in = poly_note[0] < onset < poly_note[1]
-            offset_in = poly_note[0] < offset < poly_note[1]
-            if onset_in or offset_in:
-                esn_to_be_deleted.append(index_n)
-    esn_poly_removed = np.delete(esn_poly_removed, esn_to_be_deleted, axis=0)
-    return esn_poly_removed
+    esn_tab = NoteTable.from_notes(esn_list)
+    poly_mask = np.asarray(poly_mask, dtype=float).reshape(-1, 2)
+    def inside(t):
+        return ((poly_mask[:,0] < t[:,None]) & (t[:,None] < poly_mask[:,1])).any(axis=1)
+    return esn_tab.filter(~(inside(esn_tab.onset) | inside(esn_tab.offset)))
 
 def eval_esn_from_files(ans_fp, pred_fp, output_dir, filename, 
                     onset_tolerance=0.1, offset_ratio=None, 
                     string=None, mode='w', verbose=False, 
                     separator=' ', poly_mask=None, extension=''):
-    ans = np.loadtxt(ans_fp)
-    ans_list = np.array([Note(nt[0], nt[1], nt[2]) for nt in ans])
-    pred = np.loadtxt(pred_fp)
-    pred_list = np.array([Note(nt[0], nt[1], nt[2]) for nt in pred])
+    ans_list = NoteTable.load(ans_fp, techs=False)
+    pred_list = NoteTable.load(pred_fp, techs=False)
     evaluation_esn(ans_list, pred_list, output_dir, filename, 
                     onset_tolerance, offset_ratio, 
                     string, mode, verbose, 
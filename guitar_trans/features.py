@@ -0,0 +1,287 @@
+import sys, time, threading, Queue
+import numpy as np
+import librosa as rosa
+from parameters import MC_LENGTH, SAMPLING_RATE, HOP_LENGTH
+
+#===== FEATURES =====#
+
+### librosa renamed logamplitude() to power_to_db() in 0.6
+_power_to_db = getattr(rosa, 'power_to_db', None) or getattr(rosa, 'logamplitude')
+
+def replace_leading_ending_zeros(array):
+    for idx, a in enumerate(array):
+        if a > 0:
+            array[:idx] = array[idx]
+            break
+    for idx, a in enumerate(reversed(array)):
+        if a > 0:
+            i = len(array)-1-idx
+            array[i:] = array[i]
+            break
+
+def fit_melody_window(mc, length=MC_LENGTH):
+    ### Pad or cut a clip's melody contour to length frames and fill its unvoiced ends
+    if len(mc) < length:
+        mc = np.pad(mc, (0, length-len(mc)), 'edge')
+    elif len(mc) > length:
+        mc = mc[:length]
+    replace_leading_ending_zeros(mc)
+    return mc
+
+class SongFeatures(object):
+    """
+    Spectral features of a whole song at HOP_LENGTH, computed on first use.
+    Frame i of the mel spectrogram is centered at sample i * HOP_LENGTH,
+    the same as frame 0 of a clip starting there, so window(i) holds the
+    MC_LENGTH mel frames a candidate clip from frame i would produce. Only
+    the frames at the clip edges differ, because the song has real audio
+    where a clip is padded.
+
+    All blocks come from one mel power spectrogram: the MFCCs are taken
+    from its log power, as rosa.feature.mfcc() would compute them from
+    the audio, and the deltas from the MFCCs. The log power is floored
+    80 dB below the loudest frame and the deltas see the frames they are
+    given, so a window derives them from its own mel frames, like a clip
+    does. The same class serves single clips through matrix(). Matrices
+    are computed once even when several threads ask for them at the same
+    time.
+    """
+    N_FFT = 512
+    N_MFCC = 13
+    N_MELS = 128
+
+    def __init__(self, audio, sr=SAMPLING_RATE, melspec=None):
+        self.audio = audio
+        self.sr = sr
+        self.__mats = {} if melspec is None else {'melspec': melspec}
+        self.__lock = threading.RLock()
+
+    def matrix(self, name):
+        if name in self.__mats:
+            return self.__mats[name]
+        with self.__lock:
+            if name in self.__mats:
+                return self.__mats[name]
+            if name == 'mfcc':
+                mat = rosa.feature.mfcc(S=_power_to_db(self.matrix('melspec')), n_mfcc=self.N_MFCC)
+            elif name == 'mfcc_d':
+                mat = rosa.feature.delta(self.matrix('mfcc'))
+            elif name == 'mfcc_d2':
+                mat = rosa.feature.delta(self.matrix('mfcc'), order=2)
+            elif name == 'melspec':
+                mat = rosa.feature.melspectrogram(self.audio, sr=self.sr, n_fft=self.N_FFT, hop_length=HOP_LENGTH, n_mels=self.N_MELS)
+            else:
+                raise ValueError('Unknown song feature {}.'.format(name))
+            self.__mats[name] = mat
+            return mat
+
+    def window(self, start_i):
+        ### Features of the candidate clip starting at frame start_i, from the song's mel frames
+        return SongFeatures(None, self.sr, self.matrix('melspec')[:, start_i:start_i + MC_LENGTH])
+
+    def clip(self, start_i, n_bin):
+        start_bin = start_i * HOP_LENGTH
+        return self.audio[start_bin:start_bin + n_bin]
+
+class Feature(object):
+    @staticmethod
+    def extract_features(y, mc, fn, ans=None):
+        # MUST BE OVERRIDDEN
+        return None
+
+    @classmethod
+    def extract_song_features(cls, song_feat, start_i, n_bin, mc, fn, ans=None):
+        """
+        Features of the candidate clip starting at frame start_i, taken
+        from the song-level matrices of song_feat. Falls back to
+        extract_features() on the clip audio unless overridden.
+        """
+        return cls.extract_features(song_feat.clip(start_i, n_bin), mc, fn, ans)
+
+    @staticmethod
+    def melody_features(mc, norm=True):
+        nmc = (mc - np.mean(mc)) / np.std(mc) if norm else mc # normalize melody contour
+        dmc = np.gradient(nmc) # calculate the gradient (first derivative) of melody contour
+        return nmc, dmc
+
+class RawFeature(Feature):
+    @staticmethod
+    def extract_features(y, mc, fn, ans=None):
+        nmc, dmc = Feature.melody_features(mc)
+        if np.any(np.isnan([nmc, dmc])):
+            print('nan in {}.'.format(fn))
+            return None
+        ra = np.reshape(y, (1,-1))
+        # (raw_audio, melody_contour, 1st derivative of mc, answer, file_name) for each element
+        mc_all = np.reshape([mc, dmc], (2,-1)) 
+        return (ra, mc_all, fn) if ans is None else (ra, mc_all, ans, fn)
+
+class MFCCFeature(Feature):
+    @staticmethod
+    def extract_features(y, mc, fn, ans=None):
+        nmc, dmc = Feature.melody_features(mc)
+        if np.any(np.isnan([nmc, dmc])):
+            print('nan in {}.'.format(fn))
+            print(mc)
+            return None
+        spec = SongFeatures(y)
+        mfcc = spec.matrix('mfcc')
+        mfcc_d = spec.matrix('mfcc_d')
+        mfcc_d2 = spec.matrix('mfcc_d2')
+        # feat_all = np.concatenate((mfcc, mfcc_d, mfcc_d2), axis=0).astype('float32')
+        feat_all = np.concatenate((mfcc, mfcc_d, mfcc_d2, np.array([nmc]), np.array([dmc])), axis=0).astype('float32')
+        return (feat_all, fn) if ans is None else (feat_all, ans, fn)
+
+    @classmethod
+    def extract_song_features(cls, song_feat, start_i, n_bin, mc, fn, ans=None):
+        nmc, dmc = Feature.melody_features(mc)
+        if np.any(np.isnan([nmc, dmc])):
+            print('nan in {}.'.format(fn))
+            print(mc)
+            return None
+        spec = song_feat.window(start_i)
+        feat_all = np.concatenate((spec.matrix('mfcc'), spec.matrix('mfcc_d'), spec.matrix('mfcc_d2'),
+                                   np.array([nmc]), np.array([dmc])), axis=0).astype('float32')
+        return (feat_all, fn) if ans is None else (feat_all, ans, fn)
+
+class SpecFeature(Feature):
+    @staticmethod
+    def extract_features(y, mc, fn, ans=None):
+        nmc, dmc = Feature.melody_features(mc)
+        if np.any(np.isnan([nmc, dmc])):
+            print('nan in {}.'.format(fn))
+            return None
+        melspec = SongFeatures(y).matrix('melspec')
+        feat_all = np.concatenate((melspec, np.array([mc]), np.array([dmc])), axis=0).astype('float32')
+        return (feat_all, fn) if ans is None else (feat_all, ans, fn)
+
+    @classmethod
+    def extract_song_features(cls, song_feat, start_i, n_bin, mc, fn, ans=None):
+        nmc, dmc = Feature.melody_features(mc)
+        if np.any(np.isnan([nmc, dmc])):
+            print('nan in {}.'.format(fn))
+            return None
+        feat_all = np.concatenate((song_feat.window(start_i).matrix('melspec'),
+                                   np.array([mc]), np.array([dmc])), axis=0).astype('float32')
+        return (feat_all, fn) if ans is None else (feat_all, ans, fn)
+
+class CocktailFeature(Feature):
+    @staticmethod
+    def extract_features(y, mc, fn, ans=None):
+        nmc, dmc = Feature.melody_features(mc)
+        if np.any(np.isnan([nmc, dmc])):
+            print('nan in {}.'.format(fn))
+            return None
+        spec = SongFeatures(y)
+        mfcc = spec.matrix('mfcc')
+        mfcc_d = spec.matrix('mfcc_d')
+        mfcc_d2 = spec.matrix('mfcc_d2')
+        melspec = spec.matrix('melspec')
+        feat_all = np.concatenate((mfcc, mfcc_d, mfcc_d2, melspec, np.array([nmc]), np.array([dmc])), axis=0).astype('float32')
+        return (feat_all, fn) if ans is None else (feat_all, ans, fn)
+
+    @classmethod
+    def extract_song_features(cls, song_feat, start_i, n_bin, mc, fn, ans=None):
+        nmc, dmc = Feature.melody_features(mc)
+        if np.any(np.isnan([nmc, dmc])):
+            print('nan in {}.'.format(fn))
+            return None
+        spec = song_feat.window(start_i)
+        feat_all = np.concatenate((spec.matrix('mfcc'), spec.matrix('mfcc_d'), spec.matrix('mfcc_d2'),
+                                   spec.matrix('melspec'),
+                                   np.array([nmc]), np.array([dmc])), axis=0).astype('float32')
+        return (feat_all, fn) if ans is None else (feat_all, ans, fn)
+
+#===== BATCHING =====#
+
+def stack_batches(feature_list, batch_size=10, mem_budget=None):
+    """
+    Stack the features of (feature, ...) tuples into float32 batches.
+
+    Every batch is the same preallocated array of batch_size features, so
+    it must be used before the next one is taken. The last partial batch
+    is padded with zeros to keep the shape fixed.
+
+    Parameters
+    ----------
+    feature_list: list of tuple
+        Tuples whose first element is the feature array.
+    batch_size: int
+        Number of features per batch.
+    mem_budget: int, optional
+        Bytes a batch may take. Overrides batch_size when given.
+
+    Yields
+    ------
+    batch: np.ndarray, shape=(batch_size,) + feature shape
+    n_valid: int
+        Number of filled rows in batch.
+    """
+    if len(feature_list) == 0:
+        return
+    shape = np.shape(feature_list[0][0])
+    if mem_budget is not None:
+        batch_size = max(1, int(mem_budget // (4 * int(np.prod(shape)))))
+    batch_size = min(batch_size, len(feature_list))
+    batch = np.zeros((batch_size,) + shape, dtype='float32')
+    for start_idx in range(0, len(feature_list), batch_size):
+        bt = feature_list[start_idx:start_idx + batch_size]
+        for i, ft in enumerate(bt):
+            batch[i] = ft[0]
+        batch[len(bt):] = 0
+        yield batch, len(bt)
+
+class StackedFeatures(object):
+    """
+    (feature, answer, file_name) tuples stacked once into contiguous
+    arrays, so that taking a batch is a single copy instead of rebuilding
+    lists of arrays at every step.
+    """
+    def __init__(self, feature_list):
+        self.feat = np.array([ft[0] for ft in feature_list], dtype='float32')
+        self.ans = np.array([ft[1] for ft in feature_list], dtype='int32')
+        self.fn = [ft[-1] for ft in feature_list]
+
+    def __len__(self):
+        return len(self.fn)
+
+    def batches(self, batchsize, shuffle=False, extra=()):
+        ### Arrays in extra are batched along with the features and answers
+        order = np.random.permutation(len(self)) if shuffle else np.arange(len(self))
+        for start_idx in range(0, len(self), batchsize):
+            idx = order[start_idx:start_idx + batchsize]
+            yield (self.feat[idx], self.ans[idx]) + tuple(arr[idx] for arr in extra)
+
+class Prefetcher(object):
+    """
+    Iterate over batches that a background thread produces, keeping up to
+    depth batches ready while the caller computes. The seconds the caller
+    spent waiting for a batch add up in wait_time.
+    """
+    def __init__(self, batches, depth=2):
+        self.batches = batches
+        self.depth = depth
+        self.wait_time = 0.0
+
+    def __produce(self, queue):
+        try:
+            for bt in self.batches:
+                queue.put((True, bt))
+            queue.put((False, None))
+        except Exception:
+            queue.put((False, sys.exc_info()))
+
+    def __iter__(self):
+        queue = Queue.Queue(self.depth)
+        thread = threading.Thread(target=self.__produce, args=(queue,))
+        thread.daemon = True
+        thread.start()
+        while True:
+            start_time = time.time()
+            ok, item = queue.get()
+            self.wait_time += time.time() - start_time
+            if not ok:
+                if item is not None:
+                    raise item[0], item[1], item[2]
+                break
+            yield item
@@ -0,0 +1,96 @@
+import warnings
+import numpy as np
+from np_models import softmax
+from parameters import NUM_CLASS
+
+#===== CONTOUR FEATURES =====#
+
+CONTOUR_FEATURES = ('extent', 'net_change', 'max_step', 'step_share', 'slope_std', 'moving', 'turns')
+
+def contour_features(mc_list):
+    """
+    Features of (N, MC_LENGTH) melody contour windows in MIDI numbers,
+    computed for all windows at once (see CONTOUR_FEATURES). Unvoiced
+    frames (0) are ignored; a window without voiced frames gets nan.
+    """
+    mc = np.array(mc_list, dtype='float64', ndmin=2)
+    mc[mc <= 0] = np.nan
+    d = np.diff(mc, axis=1)
+    ad = np.abs(d)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        extent = np.nanmax(mc, axis=1) - np.nanmin(mc, axis=1)
+        net_change = np.abs(np.nanmean(mc[:, -5:], axis=1) - np.nanmean(mc[:, :5], axis=1))
+        max_step = np.nanmax(ad, axis=1)
+        step_share = max_step / np.maximum(extent, 1e-3)
+        slope_std = np.nanstd(d, axis=1)
+        ### Frames gliding by more than 0.1 semitone, and turns of the slope (vibrato)
+        moving = np.sum(ad > 0.1, axis=1)
+        sd = np.sign(d)
+        turns = np.sum(sd[:, 1:] * sd[:, :-1] < 0, axis=1)
+    return np.column_stack((extent, net_change, max_step, step_share, slope_std, moving, turns))
+
+#===== GATE =====#
+
+class ContourGate(object):
+    """
+    Multinomial logistic regression over contour_features(), one per
+    direction. A candidate whose top class probability reaches the
+    threshold of its direction is labeled by the gate; the others are left
+    to the CNN. Thresholds default to inf, which sends everything to the
+    CNN until they are calibrated (see calibrate_gate.py).
+    """
+    def __init__(self, params=None):
+        ### {direction: [mean, std, W, b, threshold]}
+        self.params = {} if params is None else params
+
+    def fit(self, direction, mc_list, ans, n_iter=500, learning_rate=0.5, l2=1e-3, threshold=np.inf):
+        """
+        Fit the gate of direction on contour windows and their answers
+        (class indices) with full-batch gradient descent.
+        """
+        x = contour_features(mc_list)
+        ok = np.all(np.isfinite(x), axis=1)
+        x, ans = x[ok], np.asarray(ans)[ok]
+        mean, std = x.mean(axis=0), x.std(axis=0) + 1e-8
+        x = (x - mean) / std
+        y = np.eye(NUM_CLASS)[ans]
+        W, b = np.zeros((x.shape[1], NUM_CLASS)), np.zeros(NUM_CLASS)
+        for _ in range(n_iter):
+            g = (softmax(x.dot(W) + b) - y) / len(x)
+            W -= learning_rate * (x.T.dot(g) + l2 * W)
+            b -= learning_rate * g.sum(axis=0)
+        self.params[direction] = [mean, std, W, b, threshold]
+        return self
+
+    def predict_proba(self, direction, mc_list):
+        mean, std, W, b, threshold = self.params[direction]
+        x = (contour_features(mc_list) - mean) / std
+        return softmax(x.dot(W) + b)
+
+    def decide(self, direction, mc_list):
+        """
+        Return (confident, pred): a mask of the candidates labeled by the
+        gate and the gate's probabilities for every candidate. Windows
+        with nan features are never confident.
+        """
+        prob = self.predict_proba(direction, mc_list)
+        conf = np.where(np.all(np.isfinite(prob), axis=1), np.max(prob, axis=1), 0.)
+        return conf >= self.params[direction][4], prob
+
+    def save(self, save_fp):
+        arrays = {}
+        for direction, params in self.params.items():
+            for name, value in zip(('mean', 'std', 'W', 'b', 'threshold'), params):
+                arrays[direction + '.' + name] = value
+        np.savez(save_fp, **arrays)
+
+    @staticmethod
+    def load(gate_fp):
+        npzfile = np.load(gate_fp)
+        params = {}
+        for key in npzfile.files:
+            direction, name = key.rsplit('.', 1)
+            params.setdefault(direction, {})[name] = npzfile[key]
+        return ContourGate({d: [p['mean'], p['std'], p['W'], p['b'], float(p['threshold'])]
+                            for d, p in params.items()})
@@ -1,6 +1,5 @@
-import os, sys, time, random
+import os, sys, time, random, threading, cPickle
 import numpy as np
-import librosa as rosa
 import theano
 import theano.tensor as T
 import lasagne
@@ -8,6 +7,8 @@ import pprint
 from lasagne import layers
 from sklearn.metrics import confusion_matrix
 from parameters import MC_LENGTH, SAMPLING_RATE, HOP_LENGTH
+from features import *
+from np_models import NumpyModel
 
 #===== FUNCTIONS =====#
 
@@ -18,82 +19,28 @@ def log_softmax(x):
 def categorical_crossentropy_logdomain(log_predictions, targets):
     return -T.sum(targets * log_predictions, axis=1)
 
-#===== FUNCTIONS =====#
+def time_mask(lengths, n_frames):
+    ### (batch, n_frames) mask of the frames before each clip's length
+    return T.lt(T.arange(n_frames).dimshuffle('x', 0), lengths.dimshuffle(0, 'x')).astype(theano.config.floatX)
 
-class Feature(object):
-    @staticmethod
-    def extract_features(y, mc, fn, ans=None):
-        # MUST BE OVERRIDDEN
-        return None
+def output_length(layer, length):
+    ### Output length of a Conv1DLayer or Pool1DLayer for inputs of (symbolic) length
+    if isinstance(layer, layers.Pool1DLayer):
+        return layers.pool.pool_output_length(length, layer.pool_size[0], layer.stride[0], 
+                                              layer.pad[0], layer.ignore_border)
+    pad = layer.pad if isinstance(layer.pad, str) else layer.pad[0]
+    return layers.conv.conv_output_length(length, layer.filter_size[0], layer.stride[0], pad)
 
-    @staticmethod
-    def melody_features(mc, norm=True):
-        nmc = (mc - np.mean(mc)) / np.std(mc) if norm else mc # normalize melody contour
-        dmc = np.gradient(nmc) # calculate the gradient (first derivative) of melody contour
-        return nmc, dmc
-
-class RawFeature(Feature):
-    @staticmethod
-    def extract_features(y, mc, fn, ans=None):
-        nmc, dmc = Feature.melody_features(mc)
-        if np.any(np.isnan([nmc, dmc])):
-            print('nan in {}.'.format(fn))
-            return None
-        ra = np.reshape(y, (1,-1))
-        # (raw_audio, melody_contour, 1st derivative of mc, answer, file_name) for each element
-        mc_all = np.reshape([mc, dmc], (2,-1)) 
-        return (ra, mc_all, fn) if ans is None else (ra, mc_all, ans, fn)
-
-class MFCCFeature(Feature):
-    @staticmethod
-    def extract_features(y, mc, fn, ans=None):
-        nmc, dmc = Feature.melody_features(mc)
-        if np.any(np.isnan([nmc, dmc])):
-            print('nan in {}.'.format(fn))
-            print(mc)
-            return None
-        n_mfcc = 13
-        mfcc = rosa.feature.mfcc(y, sr=SAMPLING_RATE, n_mfcc=n_mfcc, n_fft=512, hop_length=HOP_LENGTH)
-        mfcc_d = rosa.feature.delta(mfcc)
-        mfcc_d2 = rosa.feature.delta(mfcc, order=2)
-        # feat_all = np.concatenate((mfcc, mfcc_d, mfcc_d2), axis=0).astype('float32')
-        feat_all = np.concatenate((mfcc, mfcc_d, mfcc_d2, np.array([nmc]), np.array([dmc])), axis=0).astype('float32')
-        return (feat_all, fn) if ans is None else (feat_all, ans, fn)
-
-class SpecFeature(Feature):
-    @staticmethod
-    def extract_features(y, mc, fn, ans=None):
-        nmc, dmc = Feature.melody_features(mc)
-        if np.any(np.isnan([nmc, dmc])):
-            print('nan in {}.'.format(fn))
-            return None
-        n_mels = 128
-        melspec = rosa.feature.melspectrogram(y, sr=SAMPLING_RATE, n_fft=512, hop_length=HOP_LENGTH, n_mels=n_mels)
-        feat_all = np.concatenate((melspec, np.array([mc]), np.array([dmc])), axis=0).astype('float32')
-        return (feat_all, fn) if ans is None else (feat_all, ans, fn)
-
-class CocktailFeature(Feature):
-    @staticmethod
-    def extract_features(y, mc, fn, ans=None):
-        nmc, dmc = Feature.melody_features(mc)
-        if np.any(np.isnan([nmc, dmc])):
-            print('nan in {}.'.format(fn))
-            return None
-        n_mels = 128
-        n_mfcc = 13
-        mfcc = rosa.feature.mfcc(y, sr=SAMPLING_RATE, n_mfcc=n_mfcc, n_fft=512, hop_length=HOP_LENGTH)
-        mfcc_d = rosa.feature.delta(mfcc)
-        mfcc_d2 = rosa.feature.delta(mfcc, order=2)
-        melspec = rosa.feature.melspectrogram(y, sr=SAMPLING_RATE, n_fft=512, hop_length=HOP_LENGTH, n_mels=n_mels)
-        feat_all = np.concatenate((mfcc, mfcc_d, mfcc_d2, melspec, np.array([nmc]), np.array([dmc])), axis=0).astype('float32')
-        return (feat_all, fn) if ans is None else (feat_all, ans, fn)
+#===== FUNCTIONS =====#
 
 #===== MODELS =====#
 
 class Model(object):
-    def __init__(self, net_opts, fp):
+    def __init__(self, net_opts, fp, inference=False):
         self.net_opts = net_opts
         self.fp = fp
+        self.inference = inference
+        self.opt_state = []
         self.init_model()
 
     #===== LAYERS =====#
@@ -132,23 +79,56 @@ class Model(object):
         self.network = None
         return self.network
 
-    def train(self, feature_list, num_epochs=60):
+    def init_inference(self, input_vars):
+        """
+        Compile only the deterministic forward pass as run_fn, for models
+        that are loaded to predict and never trained.
+        """
+        print('Building inference function...')
+        test_prediction = layers.get_output(self.network, deterministic=True)
+        self.train_fn = None
+        self.val_fn = None
+        self.run_fn = theano.function(input_vars, 
+                                      [test_prediction], 
+                                      on_unused_input='ignore')
+
+    def train(self, feature_list, num_epochs=60, patience=None, resume=False):
+        """
+        Train for num_epochs, or until the validation loss has not improved
+        for patience epochs. A checkpoint with everything needed to go on
+        is written after each epoch; with resume=True, training continues
+        from the checkpoint of an interrupted run of the same model file.
+        """
         print('Start training...')
         sys.stdout.flush()
-        np.random.shuffle(feature_list)
-        ch = len(feature_list) / 5
-        val_list, train_list = feature_list[:ch], feature_list[ch:]
-        lowest_loss = 100.0
         temp_model_file = '.temp_{}'.format(os.path.basename(self.fp))
         temp_model_fp = os.path.join(os.path.dirname(self.fp), temp_model_file)
-        for epoch in range(num_epochs):
+        ckpt_file = '.ckpt_{}.pkl'.format(os.path.basename(self.fp))
+        ckpt_fp = os.path.join(os.path.dirname(self.fp), ckpt_file)
+        if resume and os.path.exists(ckpt_fp):
+            ckpt = self.load_checkpoint(ckpt_fp)
+            by_name = dict((ft[-1], ft) for ft in feature_list)
+            val_list = [by_name[fn] for fn in ckpt['val_fns']]
+            train_list = [by_name[fn] for fn in ckpt['train_fns']]
+            start_epoch, lowest_loss, bad_epochs = ckpt['epoch'], ckpt['lowest_loss'], ckpt['bad_epochs']
+            print('Resume from epoch {}.'.format(start_epoch + 1))
+        else:
+            np.random.shuffle(feature_list)
+            ch = len(feature_list) / 5
+            val_list, train_list = feature_list[:ch], feature_list[ch:]
+            start_epoch, lowest_loss, bad_epochs = 0, 100.0, 0
+        val_fns, train_fns = [ft[-1] for ft in val_list], [ft[-1] for ft in train_list]
+        train_list, val_list = self.prepare_data(train_list), self.prepare_data(val_list)
+        for epoch in range(start_epoch, num_epochs):
             start_time = time.time()
+            self.data_wait = 0.0
             train_err, train_batches = self.train_one(train_list)
             val_err, val_acc, val_batches = self.val_one(val_list)
             
             # Print the results for this epoch:
-            print("Epoch {} of {} took {:.3f}s".format(
-                epoch + 1, num_epochs, time.time() - start_time))
+            epoch_time = time.time() - start_time
+            print("Epoch {} of {} took {:.3f}s ({:.3f}s waiting for data, {:.3f}s computing)".format(
+                epoch + 1, num_epochs, epoch_time, self.data_wait, epoch_time - self.data_wait))
             print("  training loss:\t\t{:.6f}".format(train_err / train_batches))
             val_loss = val_err / val_batches
             print("  validation loss:\t\t{:.6f}".format(val_loss))
@@ -158,22 +138,84 @@ class Model(object):
             # Save the lowest loss
             if val_loss < lowest_loss:
                 lowest_loss = val_loss
+                bad_epochs = 0
                 final_param = lasagne.layers.get_all_param_values(self.network)
                 self.save(temp_model_fp, final_param)
+            else:
+                bad_epochs += 1
+
+            self.save_checkpoint(ckpt_fp, {'epoch': epoch + 1, 'lowest_loss': lowest_loss, 
+                                           'bad_epochs': bad_epochs, 
+                                           'train_fns': train_fns, 'val_fns': val_fns})
+            if patience is not None and bad_epochs >= patience:
+                print('Validation loss has not improved for {} epochs. Stop training.'.format(bad_epochs))
+                break
 
         os.rename(temp_model_fp, self.fp)
+        os.remove(ckpt_fp)
+
+    def random_streams(self):
+        ### Shared random states of the dropout layers
+        return [st for l in layers.get_all_layers(self.network) if hasattr(l, '_srng') 
+                   for st, _ in l._srng.state_updates]
+
+    def save_checkpoint(self, ckpt_fp, state):
+        state = dict(state)
+        state['params'] = lasagne.layers.get_all_param_values(self.network)
+        state['opt_state'] = [v.get_value() for v in self.opt_state]
+        state['srng_state'] = [v.get_value() for v in self.random_streams()]
+        state['np_rng'] = np.random.get_state()
+        state['py_rng'] = random.getstate()
+        temp_fp = ckpt_fp + '.part'
+        with open(temp_fp, 'wb') as fh:
+            cPickle.dump(state, fh, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp_fp, ckpt_fp)
+
+    def load_checkpoint(self, ckpt_fp):
+        with open(ckpt_fp, 'rb') as fh:
+            state = cPickle.load(fh)
+        self.set_param_values(state['params'])
+        for v, val in zip(self.opt_state, state['opt_state']):
+            v.set_value(val)
+        for v, val in zip(self.random_streams(), state['srng_state']):
+            v.set_value(val)
+        np.random.set_state(state['np_rng'])
+        random.setstate(state['py_rng'])
+        return state
 
     def test(self, feature_list):
         # MUST BE OVERRIDDEN
         return None
 
-    def run(self, feature_list):
+    def prepare_data(self, feature_list):
+        ### Done once per training run; models may stack the features here
+        return feature_list
+
+    def prefetch(self, batches):
+        """
+        Iterate batches assembled on a background thread, adding the time
+        spent waiting for them to self.data_wait.
+        """
+        loader = Prefetcher(batches)
+        for bt in loader:
+            yield bt
+        self.data_wait = getattr(self, 'data_wait', 0.0) + loader.wait_time
+
+    def run(self, feature_list, batch_size=10, mem_budget=None):
+        """
+        Predict (feature, file_name) tuples in fixed-shape float32 batches
+        (see stack_batches). The seconds spent on each batch are kept in
+        self.batch_times.
+        """
+        ### run_fn is the deterministic output, so the zeros padding the last batch change no prediction
         pred_list = []
-        for bt in self.iterate_minibatches(feature_list, 10):
-            feat, fn = zip(*bt)
-            pred = self.run_fn(list(feat))
-            pred_list += pred[0].tolist()
-        pred_list = np.array(pred_list)
+        self.batch_times = []
+        for batch, n_valid in stack_batches(feature_list, batch_size, mem_budget):
+            start_time = time.time()
+            pred = self.run_fn(batch)
+            pred_list.append(np.array(pred[0][:n_valid]))
+            self.batch_times.append(time.time() - start_time)
+        pred_list = np.concatenate(pred_list) if pred_list else np.array([])
         return pred_list
 
     def set_param_values(self, val):
@@ -204,14 +246,33 @@ class Model(object):
                           params=params)
 
     @staticmethod
-    def init_from_file(model_fp):
+    def init_from_file(model_fp, inference=False):
         npzfile = np.load(model_fp)
         print npzfile['class_name']
         model_class = globals()[npzfile['class_name'].item()]
-        model = model_class(npzfile['net_opts'].item(), model_fp)
+        model = model_class(npzfile['net_opts'].item(), model_fp, inference=inference)
         model.set_param_values(npzfile['params'])
         return model
 
+    @staticmethod
+    def load(model_fp, inference=True):
+        """
+        Model of model_fp, built once per process and shared by later
+        calls. The file is reloaded when its modification time changes.
+        """
+        key = (os.path.abspath(model_fp), inference)
+        mtime = os.path.getmtime(model_fp)
+        with _REGISTRY_LOCK:
+            model = _MODEL_REGISTRY.get(key)
+            if model is None or model[0] != mtime:
+                model = (mtime, Model.init_from_file(model_fp, inference=inference))
+                _MODEL_REGISTRY[key] = model
+        return model[1]
+
+### Models loaded by Model.load(), as {(abspath, inference): (mtime, model)}
+_MODEL_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+
 ##### MLP Network
 class DNNModel(Model):
     def init_model(self):
@@ -219,6 +280,9 @@ class DNNModel(Model):
         mfcc_input_var = T.tensor3('mfcc_input')
         target_var = T.imatrix('targets')
         network = self.build_network(mfcc_input_var)
+        if self.inference:
+            self.init_inference([mfcc_input_var])
+            return
         prediction = layers.get_output(network)
         prediction = T.clip(prediction, 1e-7, 1.0 - 1e-7)
         loss = lasagne.objectives.categorical_crossentropy(prediction, target_var)
@@ -226,6 +290,7 @@ class DNNModel(Model):
         params = layers.get_all_params(network, trainable=True)
         # updates = lasagne.updates.adagrad(loss, params, learning_rate=0.002)
         updates = lasagne.updates.sgd(loss, params, learning_rate=0.02)
+        self.opt_state = [v for v in updates if v not in set(params)]
 
         test_prediction = layers.get_output(network, deterministic=True)
         test_loss = lasagne.objectives.categorical_crossentropy(test_prediction,
@@ -243,17 +308,21 @@ class DNNModel(Model):
                                         [test_loss, test_acc, test_prediction], 
                                         on_unused_input='ignore')
         self.run_fn = theano.function([mfcc_input_var],
-                                        [prediction],
+                                        [test_prediction],
                                         on_unused_input='ignore')
 
+    def prepare_data(self, feature_list):
+        if isinstance(feature_list, StackedFeatures):
+            return feature_list
+        return StackedFeatures(feature_list)
+
     def test(self, feature_list):
         test_err = 0
         test_acc = 0
         test_batches = 0
         ans_list, pred_list = [], []
-        for bt in self.iterate_minibatches(feature_list, 10):
-            feat, ans, fn = zip(*bt)
-            err, acc, pred = self.val_fn(list(feat), list(ans))
+        for feat, ans in self.prefetch(self.prepare_data(feature_list).batches(10)):
+            err, acc, pred = self.val_fn(feat, ans)
             test_err += err
             test_acc += acc
             test_batches += 1
@@ -270,9 +339,8 @@ class DNNModel(Model):
     def train_one(self, train_list):
         train_err = 0
         train_batches = 0
-        for bt in self.iterate_minibatches(train_list, 10):
-            feat, ans, fn = zip(*bt)
-            err, pred = self.train_fn(list(feat), list(ans))
+        for feat, ans in self.prefetch(self.prepare_data(train_list).batches(10, shuffle=True)):
+            err, pred = self.train_fn(feat, ans)
             # if random.randint(0, 19) == 0:
             #   print 'err', err
             #   print 'pred', pred
@@ -284,9 +352,8 @@ class DNNModel(Model):
         val_err = 0
         val_acc = 0
         val_batches = 0
-        for bt in self.iterate_minibatches(val_list, 10):
-            feat, ans, fn = zip(*bt)
-            err, acc, pred = self.val_fn(list(feat), list(ans))
+        for feat, ans in self.prefetch(self.prepare_data(val_list).batches(10)):
+            err, acc, pred = self.val_fn(feat, ans)
             val_err += err
             val_acc += acc
             val_batches += 1
@@ -414,6 +481,100 @@ class CocktailCNNModel(DNNModel, CocktailFeature):
 
     
 
+##### Distillation
+class MFCCStudentCNNModel(DNNModel, MFCCFeature):
+    """
+    Small CNN trained on the answers and on the outputs of a larger
+    teacher model, softened by net_opts['temperature']. The teacher of
+    each fold is the file net_opts['teacher'] formatted with the fold and
+    direction of this model's file, so it has not seen the test fold.
+    """
+    def init_model(self):
+        print('Initializing model...')
+        mfcc_input_var = T.tensor3('mfcc_input')
+        target_var = T.imatrix('targets')
+        soft_target_var = T.matrix('soft_targets')
+        network = self.build_network(mfcc_input_var)
+        if self.inference:
+            self.init_inference([mfcc_input_var])
+            return
+        temperature = self.net_opts['temperature']
+        soft_weight = self.net_opts['soft_weight']
+        prediction = layers.get_output(network)
+        prediction = T.clip(prediction, 1e-7, 1.0 - 1e-7)
+        hard_loss = lasagne.objectives.categorical_crossentropy(prediction, target_var)
+        soft_loss = categorical_crossentropy_logdomain(log_softmax(T.log(prediction) / temperature), 
+                                                       soft_target_var)
+        ### Soft gradients scale with 1/temperature^2, so the soft loss is scaled back up
+        loss = (1 - soft_weight) * hard_loss + soft_weight * temperature ** 2 * soft_loss
+        loss = loss.mean()
+        params = layers.get_all_params(network, trainable=True)
+        updates = lasagne.updates.sgd(loss, params, learning_rate=0.02)
+        self.opt_state = [v for v in updates if v not in set(params)]
+
+        test_prediction = layers.get_output(network, deterministic=True)
+        test_loss = lasagne.objectives.categorical_crossentropy(test_prediction,
+                                                                target_var)
+        test_loss = test_loss.mean()
+        test_acc = T.mean(T.eq(T.argmax(test_prediction, axis=1), T.argmax(target_var, axis=1)),
+                          dtype=theano.config.floatX)
+
+        print('Building functions...')
+        self.train_fn = theano.function([mfcc_input_var, target_var, soft_target_var], 
+                                        [loss, prediction], 
+                                        updates=updates, 
+                                        on_unused_input='ignore')
+        self.val_fn = theano.function([mfcc_input_var, target_var], 
+                                        [test_loss, test_acc, test_prediction], 
+                                        on_unused_input='ignore')
+        self.run_fn = theano.function([mfcc_input_var],
+                                        [test_prediction],
+                                        on_unused_input='ignore')
+
+    def build_network(self, mfcc_input_var):
+        print('Building student cnn with parameters:')
+        pp = pprint.PrettyPrinter(indent=4)
+        pp.pprint(self.net_opts)
+
+        mfcc_network = layers.InputLayer((None, 41, MC_LENGTH), mfcc_input_var)
+        mfcc_network = layers.BatchNormLayer(mfcc_network)
+        mfcc_network = self.set_conv_layer(mfcc_network, 'conv_1', dropout=False)
+        mfcc_network = self.set_pool_layer(mfcc_network, 'pool_1')
+        for n in self.net_opts['layer_list']:
+            mfcc_network = layers.DenseLayer(layers.dropout(mfcc_network, p=self.net_opts['dropout_p']), 
+                                            n, 
+                                            nonlinearity=lasagne.nonlinearities.rectify)
+        mfcc_network = layers.DenseLayer(layers.dropout(mfcc_network, p=self.net_opts['dropout_p']), 
+                                        self.net_opts['num_class'], 
+                                        nonlinearity=lasagne.nonlinearities.softmax)
+        
+        self.network = mfcc_network
+        return self.network
+
+    def teacher_fp(self):
+        ### Model files of classification.classify() are named <model_name>_<fold>.<direction>.npz
+        name, direction = os.path.basename(self.fp).split('.')[:2]
+        return self.net_opts['teacher'].format(fold=name.split('_')[-1], direction=direction)
+
+    def soft_targets(self, data):
+        if getattr(data, 'soft', None) is None:
+            print('Running teacher {}...'.format(self.teacher_fp()))
+            teacher = NumpyModel.init_from_file(self.teacher_fp())
+            log_prob = np.log(np.clip(teacher.run(zip(data.feat, data.fn)), 1e-7, 1.0)) / self.net_opts['temperature']
+            soft = np.exp(log_prob - log_prob.max(axis=1, keepdims=True))
+            data.soft = (soft / soft.sum(axis=1, keepdims=True)).astype('float32')
+        return data.soft
+
+    def train_one(self, train_list):
+        train_err = 0
+        train_batches = 0
+        data = self.prepare_data(train_list)
+        for feat, ans, soft in self.prefetch(data.batches(10, shuffle=True, extra=(self.soft_targets(data),))):
+            err, pred = self.train_fn(feat, ans, soft)
+            train_err += err
+            train_batches += 1
+        return train_err, train_batches
+
 ##### Raw DNN 
 class RawDNNModel(Model, RawFeature):
     def init_model(self):
@@ -422,12 +583,16 @@ class RawDNNModel(Model, RawFeature):
         mc_input_var = T.tensor3('melody_contour_input')
         target_var = T.imatrix('targets')
         network = self.build_network(ra_input_var, mc_input_var)
+        if self.inference:
+            self.init_inference([ra_input_var, mc_input_var])
+            return
         prediction = layers.get_output(network)
         prediction = T.clip(prediction, 1e-7, 1.0 - 1e-7)
         loss = lasagne.objectives.categorical_crossentropy(prediction, target_var)
         loss = loss.mean()
         params = layers.get_all_params(network, trainable=True)
         updates = lasagne.updates.adagrad(loss, params, learning_rate=0.002)
+        self.opt_state = [v for v in updates if v not in set(params)]
         # updates = lasagne.updates.sgd(loss, params, learning_rate=0.02)
 
         test_prediction = layers.get_output(network, deterministic=True)
@@ -446,7 +611,7 @@ class RawDNNModel(Model, RawFeature):
                                         [test_loss, test_acc, test_prediction], 
                                         on_unused_input='ignore')
         self.run_fn = theano.function([ra_input_var, mc_input_var],
-                                        [prediction],
+                                        [test_prediction],
                                         on_unused_input='ignore')
 
     def build_network(self, ra_input_var, mc_input_var):
@@ -527,19 +692,82 @@ class RawDNNModel(Model, RawFeature):
         return val_err, val_acc, val_batches 
 
 ##### Raw Network
+class MaskedGlobalPoolLayer(layers.Layer):
+    """
+    Global pooling over the time axis of (batch, channel, time) that
+    ignores the frames past each clip's length (a symbolic vector).
+    """
+    def __init__(self, incoming, lengths, pool_function='mean', **kwargs):
+        super(MaskedGlobalPoolLayer, self).__init__(incoming, **kwargs)
+        self.lengths = lengths
+        self.pool_function = pool_function
+
+    def get_output_shape_for(self, input_shape):
+        return input_shape[:2]
+
+    def get_output_for(self, x, **kwargs):
+        m = time_mask(self.lengths, x.shape[2]).dimshuffle(0, 'x', 1)
+        if self.pool_function == 'max':
+            return T.max(T.switch(m > 0, x, -np.inf), axis=2)
+        elif self.pool_function == 'sum':
+            return T.sum(x * m, axis=2)
+        return T.sum(x * m, axis=2) / T.maximum(T.sum(m, axis=2), 1)
+
+class CenterCropConcatLayer(layers.MergeLayer):
+    """
+    Concatenation over the channels of (batch, channel, time) inputs, with
+    each clip cropped to its shortest input like ConcatLayer's 'center'
+    cropping, but from the clip's own lengths (symbolic vectors, one per
+    input) rather than the padded ones. Cropped clips start at frame 0,
+    and their frames past the crop are zero.
+    """
+    def __init__(self, incomings, lengths, **kwargs):
+        super(CenterCropConcatLayer, self).__init__(incomings, **kwargs)
+        self.lengths = lengths
+
+    def get_output_shape_for(self, input_shapes):
+        n_frames = [shape[2] for shape in input_shapes]
+        return (input_shapes[0][0], sum(shape[1] for shape in input_shapes),
+                None if None in n_frames else min(n_frames))
+
+    def get_output_for(self, inputs, **kwargs):
+        crop_len = reduce(T.minimum, self.lengths)
+        n_frames = reduce(T.minimum, [x.shape[2] for x in inputs])
+        cropped = []
+        for x, length in zip(inputs, self.lengths):
+            ### Frame t of a clip is frame (length - crop_len) // 2 + t of its input
+            start = (length - crop_len) // 2
+            idx = T.minimum(start.dimshuffle(0, 'x') + T.arange(n_frames).dimshuffle('x', 0), x.shape[2] - 1)
+            rows = (T.arange(x.shape[0]) * x.shape[2]).dimshuffle(0, 'x') + idx
+            frames = x.dimshuffle(0, 2, 1).reshape((-1, x.shape[1]))[rows.flatten()]
+            cropped.append(frames.reshape((x.shape[0], n_frames, x.shape[1])).dimshuffle(0, 2, 1))
+        return T.concatenate(cropped, axis=1) * time_mask(crop_len, n_frames).dimshuffle(0, 'x', 1)
+
 class RawNetModel(Model, RawFeature):
+    BATCH_SIZE = 10
+    ### Clips are shuffled among the BUCKET_WINDOW * BATCH_SIZE clips nearest in length before bucketing
+    BUCKET_WINDOW = 4
+    ### SGD step of one clip; a batch step averages BATCH_SIZE clips, so it is scaled by BATCH_SIZE
+    LEARNING_RATE = 0.02
+
     def init_model(self):
         print('Initializing model...')
         ra_input_var = T.tensor3('raw_audio_input')
         mc_input_var = T.tensor3('melody_contour_input')
+        ra_len_var = T.ivector('raw_audio_lengths')
+        mc_len_var = T.ivector('melody_contour_lengths')
         target_var = T.imatrix('targets')
-        network = self.build_network(ra_input_var, mc_input_var)
+        network = self.build_network(ra_input_var, mc_input_var, ra_len_var, mc_len_var)
+        if self.inference:
+            self.init_inference([ra_input_var, mc_input_var, ra_len_var, mc_len_var])
+            return
         prediction = layers.get_output(network)
         prediction = T.clip(prediction, 1e-7, 1.0 - 1e-7)
         loss = lasagne.objectives.categorical_crossentropy(prediction, target_var)
         loss = loss.mean()
         params = layers.get_all_params(network, trainable=True)
-        updates = lasagne.updates.sgd(loss, params, learning_rate=0.02)
+        updates = lasagne.updates.sgd(loss, params, learning_rate=self.LEARNING_RATE * self.BATCH_SIZE)
+        self.opt_state = [v for v in updates if v not in set(params)]
 
         test_prediction = layers.get_output(network, deterministic=True)
         test_loss = lasagne.objectives.categorical_crossentropy(test_prediction,
@@ -549,41 +777,58 @@ class RawNetModel(Model, RawFeature):
                           dtype=theano.config.floatX)
 
         print('Building functions...')
-        self.train_fn = theano.function([ra_input_var, mc_input_var, target_var], 
+        self.train_fn = theano.function([ra_input_var, mc_input_var, ra_len_var, mc_len_var, target_var], 
                                         [loss, prediction], 
                                         updates=updates, 
                                         on_unused_input='ignore')
-        self.val_fn = theano.function([ra_input_var, mc_input_var, target_var], 
+        self.val_fn = theano.function([ra_input_var, mc_input_var, ra_len_var, mc_len_var, target_var], 
                                         [test_loss, test_acc, test_prediction], 
                                         on_unused_input='ignore')
-        self.run_fn = theano.function([ra_input_var, mc_input_var],
-                                        [prediction],
+        self.run_fn = theano.function([ra_input_var, mc_input_var, ra_len_var, mc_len_var],
+                                        [test_prediction],
                                         on_unused_input='ignore')
 
-    def build_network(self, ra_input_var, mc_input_var):
+    def set_masked_conv_layer(self, network, layer_name, length, **kwargs):
+        ### Zero the frames past each clip's length, as they would be if the clip were alone
+        network = self.set_conv_layer(network, layer_name, **kwargs)
+        length = output_length(network, length)
+        return layers.ExpressionLayer(network, lambda x: x * time_mask(length, x.shape[2]).dimshuffle(0, 'x', 1)), length
+
+    def set_length_pool_layer(self, network, layer_name, length):
+        ### Frames past a clip's length are zero and the frames before are rectified, so the max is unchanged
+        network = self.set_pool_layer(network, layer_name)
+        return network, output_length(network, length)
+
+    def build_network(self, ra_input_var, mc_input_var, ra_len_var, mc_len_var):
+        """
+        Clips of a batch can be zero-padded to its longest clip: every layer
+        follows the length of each clip, so a clip gets the output it would
+        get alone.
+        """
         print('Building raw network with parameters:')
         pp = pprint.PrettyPrinter(indent=4)
         pp.pprint(self.net_opts)
 
         ra_network_1 = layers.InputLayer((None, 1, None), ra_input_var)
-        ra_network_1 = self.set_conv_layer(ra_network_1, 'ra_conv_1', dropout=False, pad='same')
-        ra_network_1 = self.set_pool_layer(ra_network_1, 'ra_pool_1')
-        ra_network_1 = self.set_conv_layer(ra_network_1, 'ra_conv_2', pad='same')
-        ra_network_1 = self.set_pool_layer(ra_network_1, 'ra_pool_2')
-        ra_network_1 = self.set_conv_layer(ra_network_1, 'ra_conv_3', pad='same')
-        ra_network_1 = self.set_pool_layer(ra_network_1, 'ra_pool_3')
-        ra_network_1 = self.set_conv_layer(ra_network_1, 'ra_conv_4', pad='same')
-        ra_network_1 = self.set_pool_layer(ra_network_1, 'ra_pool_4')
+        ra_network_1, ra_len = self.set_masked_conv_layer(ra_network_1, 'ra_conv_1', ra_len_var, dropout=False, pad='same')
+        ra_network_1, ra_len = self.set_length_pool_layer(ra_network_1, 'ra_pool_1', ra_len)
+        ra_network_1, ra_len = self.set_masked_conv_layer(ra_network_1, 'ra_conv_2', ra_len, pad='same')
+        ra_network_1, ra_len = self.set_length_pool_layer(ra_network_1, 'ra_pool_2', ra_len)
+        ra_network_1, ra_len = self.set_masked_conv_layer(ra_network_1, 'ra_conv_3', ra_len, pad='same')
+        ra_network_1, ra_len = self.set_length_pool_layer(ra_network_1, 'ra_pool_3', ra_len)
+        ra_network_1, ra_len = self.set_masked_conv_layer(ra_network_1, 'ra_conv_4', ra_len, pad='same')
+        ra_network_1, ra_len = self.set_length_pool_layer(ra_network_1, 'ra_pool_4', ra_len)
         concat_list = [ra_network_1]
         mc_input = layers.InputLayer((None, 2, None), mc_input_var)
         concat_list.append(mc_input)
-        network = layers.ConcatLayer(concat_list, axis=1, cropping=[None, None, 'center'])
-        network = self.set_conv_layer(network, 'conv_1')
-        network = self.set_pool_layer(network, 'pool_1')
-        network = self.set_conv_layer(network, 'conv_2')
-        network = self.set_pool_layer(network, 'pool_2')
-        network = self.set_conv_layer(network, 'conv_3')
-        network = layers.GlobalPoolLayer(network, getattr(T, self.net_opts['global_pool_func']))
+        network = CenterCropConcatLayer(concat_list, [ra_len, mc_len_var])
+        length = T.minimum(ra_len, mc_len_var)
+        network, length = self.set_masked_conv_layer(network, 'conv_1', length)
+        network, length = self.set_length_pool_layer(network, 'pool_1', length)
+        network, length = self.set_masked_conv_layer(network, 'conv_2', length)
+        network, length = self.set_length_pool_layer(network, 'pool_2', length)
+        network, length = self.set_masked_conv_layer(network, 'conv_3', length)
+        network = MaskedGlobalPoolLayer(network, length, self.net_opts['global_pool_func'])
         # print(layers.get_output_shape(network))
         # network = layers.DenseLayer(layers.dropout(network, p=self.net_opts['dropout_p']), 
         #                           self.net_opts['dens_1'], 
@@ -598,16 +843,59 @@ class RawNetModel(Model, RawFeature):
         self.network = network
         return self.network
 
+    def iterate_buckets(self, feature_list, batchsize, shuffle=False):
+        """
+        Batches of clips with similar raw audio lengths, zero-padded to the
+        longest clip of the batch, with the lengths of each clip. With
+        shuffle, clips are shuffled within windows of BUCKET_WINDOW batches
+        of the length order before they are cut into batches, so that the
+        batches differ from epoch to epoch, and the batch order is shuffled.
+
+        Yields
+        ------
+        (ra, mc, ra_len, mc_len, ans, idx): ans is None for tuples without
+        answers, idx lists the positions of the batch in feature_list
+        """
+        order = sorted(range(len(feature_list)), key=lambda i: feature_list[i][0].size)
+        if shuffle:
+            window = batchsize * self.BUCKET_WINDOW
+            for i in range(0, len(order), window):
+                part = order[i:i + window]
+                random.shuffle(part)
+                order[i:i + window] = part
+        buckets = [order[i:i + batchsize] for i in range(0, len(order), batchsize)]
+        if shuffle:
+            random.shuffle(buckets)
+        for bucket in buckets:
+            bt = [feature_list[i] for i in bucket]
+            ra_len = np.array([ft[0].size for ft in bt], dtype='int32')
+            mc_len = np.array([ft[1].size / 2 for ft in bt], dtype='int32')
+            ra = np.zeros((len(bt), 1, max(ra_len)), dtype='float32')
+            mc = np.zeros((len(bt), 2, max(mc_len)), dtype='float32')
+            for j, ft in enumerate(bt):
+                ra[j, 0, :ra_len[j]] = ft[0].ravel()
+                mc[j, :, :mc_len[j]] = ft[1].reshape((2, -1))
+            ans = np.array([ft[2] for ft in bt], dtype='int32') if len(bt[0]) == 4 else None
+            yield ra, mc, ra_len, mc_len, ans, bucket
+
+    def run(self, feature_list, batch_size=None, mem_budget=None):
+        pred_list = [None] * len(feature_list)
+        self.batch_times = []
+        for ra, mc, ra_len, mc_len, ans, idx in self.iterate_buckets(feature_list, batch_size or self.BATCH_SIZE):
+            start_time = time.time()
+            pred = self.run_fn(ra, mc, ra_len, mc_len)[0]
+            for i, p in zip(idx, pred):
+                pred_list[i] = p
+            self.batch_times.append(time.time() - start_time)
+        return np.array(pred_list)
+
     def test(self, feature_list):
         test_err = 0
         test_acc = 0
         test_batches = 0
         ans_list, pred_list = [], []
-        for ra, mc, ans, fi in feature_list:
-            ra = ra.reshape((1,1,-1))
-            mc = mc.reshape((1,2,-1))
-            ans = np.array([ans], dtype='int32')
-            err, acc, pred = self.val_fn(ra, mc, ans)
+        for ra, mc, ra_len, mc_len, ans, idx in self.prefetch(self.iterate_buckets(feature_list, self.BATCH_SIZE)):
+            err, acc, pred = self.val_fn(ra, mc, ra_len, mc_len, ans)
             test_err += err
             test_acc += acc
             test_batches += 1
@@ -624,14 +912,8 @@ class RawNetModel(Model, RawFeature):
     def train_one(self, train_list):
         train_err = 0
         train_batches = 0
-        for ra, mc, ans, fi in train_list:
-            ra = ra.reshape((1,1,-1))
-            mc = mc.reshape((1,2,-1))
-            ans = np.array([ans], dtype='int32')
-            err, pred = self.train_fn(ra, mc, ans)
-            # if random.randint(0, 19) == 0:
-            #   print 'pred', pred
-                # print 'll', ll
+        for ra, mc, ra_len, mc_len, ans, idx in self.prefetch(self.iterate_buckets(train_list, self.BATCH_SIZE, shuffle=True)):
+            err, pred = self.train_fn(ra, mc, ra_len, mc_len, ans)
             train_err += err
             train_batches += 1
         return train_err, train_batches
@@ -640,11 +922,8 @@ class RawNetModel(Model, RawFeature):
         val_err = 0
         val_acc = 0
         val_batches = 0
-        for ra, mc, ans, fi in val_list:
-            ra = ra.reshape((1,1,-1))
-            mc = mc.reshape((1,2,-1))
-            ans = np.array([ans], dtype='int32')
-            err, acc, pred = self.val_fn(ra, mc, ans)
+        for ra, mc, ra_len, mc_len, ans, idx in self.prefetch(self.iterate_buckets(val_list, self.BATCH_SIZE)):
+            err, acc, pred = self.val_fn(ra, mc, ra_len, mc_len, ans)
             val_err += err
             val_acc += acc
             val_batches += 1
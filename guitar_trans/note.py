@@ -3,6 +3,8 @@ from technique import *
 from contour import Segment
 
 class Note(object):
+    __slots__ = ('arr',)
+
     def __init__(self, pitch=0, onset=0.0, duration=0.0, 
                  techs=[], array=None, note=None):
         if array is not None:
@@ -65,17 +67,21 @@ class Note(object):
 
     @property
     def all_techs(self):
-        return [Tech(idx+3, t) for idx, t in enumerate(self.arr[3:])]
+        return [Tech.of(idx+3, t) for idx, t in enumerate(self.arr[3:])]
 
     def tech(self, t_num):
-        if t_num in range(3, 12):
-            return Tech(t_num, self.arr[t_num])
+        return Tech.of(t_num, self.tech_value(t_num))
+
+    def tech_value(self, t_num):
+        """
+        Value of tech t_num, without creating a Tech object.
+        """
+        if T_PREBEND <= t_num < T_NORMAL:
+            return self.arr[t_num]
         elif t_num == T_NORMAL:
-            value = 1 if np.count_nonzero(self.arr[3:]) == 0 else 0
-            return Tech(t_num, value)
+            return 1 if not self.arr[3:].any() else 0
         else:
             raise ValueError('ERROR: number of tech should be 3 ~ 12, not {}.'.format(t_num))
-            return None
 
     def merge_note(self, other):
         nt = Note.merge(self, other)
@@ -135,6 +141,8 @@ class Note(object):
 
 
 class DiscreteNote(Note):
+    __slots__ = ()
+
     def __init__(self, pitch=0, onset=0, duration=0, 
                  techs=[], array=None, note=None):
         if array is not None:
@@ -158,6 +166,8 @@ class DiscreteNote(Note):
         return Note(self.pitch, self.onset*ratio, self.duration*ratio, self.all_techs)
 
 class CandidateNote(DiscreteNote):
+    __slots__ = ('next_note', 'segs')
+
     def __init__(self, pitch=0, onset=0, duration=0, next_note=None,
                  techs=[], segs=None, array=None, note=None):
         self.next_note = next_note
@@ -189,4 +199,276 @@ class CandidateNote(DiscreteNote):
         elif note.onset == second.onset and len(first.segs) > 0:
             note.segs += [Segment(seg.val, seg.pos + first.onset - second.onset, seg.length, ref_con=seg.ref_con) for seg in first.segs]
             note.next_note = first.next_note
-        return note
\ No newline at end of file
+        return note
+
+class NoteSequence(object):
+    """
+    Ordered notes as a doubly linked list, so that looking up the neighbours
+    of a note, replacing it and deleting it are O(1). Notes are matched by
+    identity, like list.remove() does for notes. to_list() compacts the
+    remaining notes to an ordered list.
+    """
+    def __init__(self, notes=[]):
+        self.__notes = list(notes)
+        n = len(self.__notes)
+        self.__slot = {id(nt): i for i, nt in enumerate(self.__notes)}
+        self.__prev = range(-1, n - 1)
+        self.__next = range(1, n) + [-1] if n > 0 else []
+        self.__head = 0 if n > 0 else -1
+        self.__tail = n - 1
+        self.__len = n
+
+    def __len__(self):
+        return self.__len
+
+    def __contains__(self, note):
+        return id(note) in self.__slot
+
+    def __iter__(self):
+        i = self.__head
+        while i >= 0:
+            yield self.__notes[i]
+            i = self.__next[i]
+
+    @property
+    def first(self):
+        return self.__notes[self.__head] if self.__head >= 0 else None
+
+    @property
+    def last(self):
+        return self.__notes[self.__tail] if self.__tail >= 0 else None
+
+    def prev(self, note):
+        i = self.__prev[self.__slot[id(note)]]
+        return self.__notes[i] if i >= 0 else None
+
+    def next(self, note):
+        i = self.__next[self.__slot[id(note)]]
+        return self.__notes[i] if i >= 0 else None
+
+    def replace(self, note, new_note):
+        i = self.__slot.pop(id(note))
+        self.__notes[i] = new_note
+        self.__slot[id(new_note)] = i
+
+    def remove(self, note):
+        i = self.__slot.pop(id(note))
+        p, n = self.__prev[i], self.__next[i]
+        if p >= 0: self.__next[p] = n
+        else: self.__head = n
+        if n >= 0: self.__prev[n] = p
+        else: self.__tail = p
+        self.__notes[i] = None
+        self.__len -= 1
+
+    def to_list(self):
+        return list(self)
+
+class NoteTable(object):
+    """
+    Notes stored column-wise: one (N, 12) array in the layout of Note.arr,
+    plus the linkage of candidate notes (next_idx, -1 for none) and their
+    segments (segs, with the owning row in seg_note). Queries, time
+    conversion, filtering and merging work on whole columns; from_notes()
+    and to_notes() convert from and to lists of Note objects.
+    """
+    def __init__(self, arr=None, next_idx=None, segs=None, seg_note=None):
+        self.arr = np.zeros((0, 12), dtype=float) if arr is None else \
+                   np.array(arr, dtype=float, ndmin=2).reshape(-1, 12)
+        n = len(self.arr)
+        self.next_idx = np.full(n, -1, dtype=int) if next_idx is None else np.asarray(next_idx, dtype=int)
+        self.segs = list(segs) if segs is not None else []
+        self.seg_note = np.zeros(0, dtype=int) if seg_note is None else np.asarray(seg_note, dtype=int)
+
+    @staticmethod
+    def from_notes(notes):
+        if isinstance(notes, NoteTable):
+            return notes
+        notes = list(notes)
+        if len(notes) == 0:
+            return NoteTable()
+        row = {id(nt): i for i, nt in enumerate(notes)}
+        next_idx = [row.get(id(getattr(nt, 'next_note', None)), -1) for nt in notes]
+        segs, seg_note = [], []
+        for i, nt in enumerate(notes):
+            for seg in getattr(nt, 'segs', ()):
+                segs.append(seg)
+                seg_note.append(i)
+        return NoteTable(np.array([nt.arr for nt in notes], dtype=float), next_idx, segs, seg_note)
+
+    @staticmethod
+    def load(file_path, techs=True):
+        """
+        Load a note file, keeping only pitch, onset and duration if techs
+        is False or the file has no tech columns.
+        """
+        raw = np.loadtxt(file_path, ndmin=2)
+        arr = np.zeros((len(raw), 12), dtype=float)
+        n_cols = min(raw.shape[1], 12 if techs else 3)
+        arr[:, :n_cols] = raw[:, :n_cols]
+        return NoteTable(arr)
+
+    def save(self, file_path, fmt='%.8f'):
+        np.savetxt(file_path, self.arr, fmt=fmt)
+
+    def to_notes(self, cls=Note):
+        notes = [cls(array=row) for row in self.arr]
+        if cls is CandidateNote:
+            for nt, i in zip(notes, self.next_idx):
+                nt.next_note = notes[i] if i >= 0 else None
+            for seg, i in zip(self.segs, self.seg_note):
+                notes[i].segs.append(seg)
+        return notes
+
+    def __len__(self):
+        return len(self.arr)
+
+    def __iter__(self):
+        for row in self.arr:
+            yield Note(array=row)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return Note(array=self.arr[key])
+        idx = np.arange(len(self.arr))[key]
+        return self.take(idx)
+
+    def __repr__(self):
+        return 'NoteTable(' + repr(self.arr) + ')'
+
+    @property
+    def pitch(self):
+        return self.arr[:, 0]
+
+    @property
+    def onset(self):
+        return self.arr[:, 1]
+
+    @property
+    def duration(self):
+        return self.arr[:, 2]
+
+    @property
+    def offset(self):
+        return self.arr[:, 1] + self.arr[:, 2]
+
+    @property
+    def intervals(self):
+        return np.column_stack([self.onset, self.offset])
+
+    def tech_values(self, t_num):
+        """
+        Column of Note.tech_value(t_num) for all notes.
+        """
+        if T_PREBEND <= t_num < T_NORMAL:
+            return self.arr[:, t_num]
+        elif t_num == T_NORMAL:
+            return (~self.arr[:, 3:].any(axis=1)).astype(int)
+        else:
+            raise ValueError('ERROR: number of tech should be 3 ~ 12, not {}.'.format(t_num))
+
+    def has_tech(self, t_num, values=None):
+        """
+        Mask of notes with tech t_num, or with one of the given values.
+        """
+        tv = self.tech_values(t_num)
+        return tv > 0 if values is None else np.in1d(tv, values)
+
+    def to_time(self, hop_size, sr):
+        """
+        Convert onsets and durations from frames to seconds.
+        """
+        arr = self.arr.copy()
+        ratio = float(hop_size) / float(sr)
+        arr[:, 1:3] *= ratio
+        return NoteTable(arr, self.next_idx.copy(), self.segs, self.seg_note.copy())
+
+    def take(self, idx):
+        """
+        Rows idx in order; links to rows left out become -1.
+        """
+        idx = np.asarray(idx, dtype=int)
+        new_row = np.full(len(self.arr) + 1, -1, dtype=int)
+        new_row[idx] = np.arange(len(idx))
+        next_idx = new_row[self.next_idx[idx]]
+        seg_row = new_row[self.seg_note] if len(self.seg_note) > 0 else self.seg_note
+        kept = np.nonzero(seg_row >= 0)[0]
+        order = kept[np.argsort(seg_row[kept], kind='mergesort')]
+        return NoteTable(self.arr[idx], next_idx, [self.segs[i] for i in order], seg_row[order])
+
+    def filter(self, mask):
+        return self.take(np.nonzero(mask)[0])
+
+    def merge(self, linked):
+        """
+        Merge each run of rows joined by linked (linked[i] joins rows i and
+        i + 1) into one note, folding from the last row of the run the way
+        repeated CandidateNote.merge(row, merged) does: the merged note keeps
+        the segments and the next note of the later note, if that one has
+        segments, and neither otherwise.
+        """
+        n = len(self.arr)
+        if n == 0:
+            return NoteTable()
+        starts = np.nonzero(np.concatenate(([True], ~np.asarray(linked, dtype=bool))))[0]
+        ends = np.append(starts[1:], n) - 1
+        group = np.cumsum(np.in1d(np.arange(n), starts)) - 1
+        has_segs = np.bincount(self.seg_note, minlength=n) > 0 if len(self.seg_note) > 0 else np.zeros(n, dtype=bool)
+        arr = self.arr[ends].copy()
+        src = ends.copy()
+        for k in range(1, (ends - starts).max() + 1):
+            run = np.nonzero(ends - starts >= k)[0]
+            row, acc = self.arr[ends[run] - k], arr[run]
+            swap = row[:, 1] > acc[:, 1]
+            merged = NoteTable.__merge_rows(np.where(swap[:, None], acc, row), np.where(swap[:, None], row, acc))
+            acc_segs = (src[run] >= 0) & has_segs[np.maximum(src[run], 0)]
+            src[run] = np.select([(merged[:, 1] == row[:, 1]) & acc_segs, 
+                                  (merged[:, 1] == acc[:, 1]) & has_segs[ends[run] - k]], 
+                                 [src[run], ends[run] - k], -1)
+            arr[run] = merged
+        ### Links into a run point to its merged note
+        next_idx = np.where(src >= 0, self.next_idx[src], -1)
+        next_idx = np.where(next_idx >= 0, group[next_idx], -1)
+        owner = np.full(n, -1, dtype=int)
+        owner[src[src >= 0]] = np.nonzero(src >= 0)[0]
+        seg_row = owner[self.seg_note] if len(self.seg_note) > 0 else self.seg_note
+        kept = np.nonzero(seg_row >= 0)[0]
+        kept = kept[np.argsort(seg_row[kept], kind='mergesort')]
+        shift = (self.arr[self.seg_note[kept], 1] - arr[seg_row[kept], 1]).astype(int)
+        segs = [self.segs[i] if d == 0 else Segment(self.segs[i].val, self.segs[i].pos + d, self.segs[i].length, 
+                                                    ref_con=self.segs[i].ref_con) 
+                for i, d in zip(kept, shift)]
+        return NoteTable(arr, next_idx, segs, seg_row[kept])
+
+    @staticmethod
+    def __merge_rows(lead, back):
+        note = np.zeros_like(lead)
+        note[:, 0] = lead[:, 0]
+        note[:, 1] = lead[:, 1]
+        note[:, 2] = back[:, 1] + back[:, 2] - lead[:, 1]
+
+        note[:, T_VIBRATO] = np.where(lead[:, T_VIBRATO] > 0, lead[:, T_VIBRATO], back[:, T_VIBRATO])
+        note[:, T_SLIDE_IN] = lead[:, T_SLIDE_IN]
+        note[:, T_SLIDE_OUT] = back[:, T_SLIDE_OUT]
+
+        l, b = lead[:, T_SLIDE], back[:, T_SLIDE]
+        note[:, T_SLIDE] = np.select([(l == 1) & (b == 2), (l == 2) & (b == 1), l > 0], [0, 3, l], b)
+        for t in (T_HAMMER, T_PULL):
+            l, b = lead[:, t], back[:, t]
+            note[:, t] = np.select([(l == 1) & (b == 2), l > 0], [0, l], b)
+
+        both_bend = (lead[:, T_BEND] > 0) & (back[:, T_BEND] > 0) & \
+                    (lead[:, T_RELEASE] > 0) & (back[:, T_RELEASE] > 0)
+        lead_bend = ~both_bend & (lead[:, T_BEND] > 0) & (back[:, T_PREBEND] > 0) & (back[:, T_RELEASE] > 0)
+        back_bend = ~both_bend & ~lead_bend & (back[:, T_BEND] > 0) & \
+                    (lead[:, T_PREBEND] > 0) & (lead[:, T_RELEASE] > 0)
+        other = ~(both_bend | lead_bend | back_bend)
+        note[both_bend, T_PREBEND] = lead[both_bend, T_PREBEND]
+        note[both_bend, T_VIBRATO] = lead[both_bend, T_BEND]
+        note[lead_bend, T_BEND] = lead[lead_bend, T_BEND]
+        note[lead_bend, T_RELEASE] = back[lead_bend, T_RELEASE]
+        note[back_bend, T_BEND] = back[back_bend, T_BEND]
+        note[back_bend, T_RELEASE] = lead[back_bend, T_RELEASE]
+        note[back_bend, T_PREBEND] = lead[back_bend, T_PREBEND]
+        note[other, 3:6] = lead[other, 3:6]
+        return note
@@ -0,0 +1,236 @@
+import os, time, threading
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from features import *
+
+#===== LAYERS =====#
+
+def batch_norm(x, beta, gamma, mean, inv_std):
+    ### Normalize over every axis but the channels (axis 1), like lasagne's BatchNormLayer
+    shape = (1, -1) + (1,) * (x.ndim - 2)
+    return (x - mean.reshape(shape)) * (gamma * inv_std).reshape(shape) + beta.reshape(shape)
+
+def conv1d(x, W, b, stride=1, pad=0):
+    """
+    Convolution of x (batch, channel, time) with filters W (filter, 
+    channel, size), flipping the filters like lasagne's Conv1DLayer.
+    """
+    size = W.shape[2]
+    if pad == 'same':
+        pad = size // 2
+    if pad > 0:
+        x = np.pad(x, ((0, 0), (0, 0), (pad, pad)), 'constant')
+    n_out = (x.shape[2] - size) // stride + 1
+    win = as_strided(x, shape=x.shape[:2] + (n_out, size), 
+                     strides=x.strides[:2] + (x.strides[2] * stride, x.strides[2]))
+    return np.einsum('nctk,fck->nft', win, W[:, :, ::-1]) + b.reshape(1, -1, 1)
+
+### The partial window is left out of the max and the mean, i.e. the end is padded with nan
+POOL_MODES = ('max', 'average_exc_pad')
+
+def pool1d(x, pool_size, mode='max'):
+    """
+    Pooling over time with stride pool_size, keeping the partial window at
+    the end like lasagne's Pool1DLayer with ignore_border=False. Only the
+    'max' and 'average_exc_pad' modes are supported.
+    """
+    if mode not in POOL_MODES:
+        raise ValueError('pool mode should be one of {}, not {}.'.format(POOL_MODES, mode))
+    n_out = (x.shape[2] - 1) // pool_size + 1
+    padded = np.full(x.shape[:2] + (n_out * pool_size,), np.nan, dtype=x.dtype)
+    padded[:, :, :x.shape[2]] = x
+    win = padded.reshape(x.shape[:2] + (n_out, pool_size))
+    return np.nanmax(win, axis=3) if mode == 'max' else np.nanmean(win, axis=3)
+
+def dense(x, W, b):
+    return np.dot(x.reshape(len(x), -1), W) + b
+
+def rectify(x):
+    return np.maximum(x, 0)
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+#===== QUANTIZATION =====#
+
+PRECISIONS = ('float32', 'float16', 'int8')
+
+def quantize_params(params, precision):
+    """
+    Convert the parameters of a model to a smaller storage type. Inference
+    still runs in float32 (see dequantize_params).
+
+    float16 casts every parameter. int8 quantizes the weights (arrays of
+    two or more dimensions) symmetrically per output channel, i.e. per
+    column of a dense weight and per filter of a conv weight, and keeps
+    biases and batch norm parameters in float32.
+
+    Returns
+    -------
+    q_params: list of np.ndarray
+    scales: list of np.ndarray or None
+        Per-channel scales of the int8 weights, None for other parameters.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('precision should be one of {}, not {}.'.format(PRECISIONS, precision))
+    q_params, scales = [], []
+    for p in params:
+        p = np.asarray(p, dtype='float32')
+        if precision == 'int8' and p.ndim >= 2:
+            axes = (0,) if p.ndim == 2 else tuple(range(1, p.ndim))
+            scale = np.abs(p).max(axis=axes, keepdims=True) / 127.
+            scale[scale == 0] = 1.
+            q_params.append(np.round(p / scale).astype('int8'))
+            scales.append(scale.astype('float32'))
+        else:
+            q_params.append(p.astype('float16') if precision == 'float16' else p)
+            scales.append(None)
+    return q_params, scales
+
+def dequantize_params(params, scales):
+    ### Conversion only shrinks the files. NumPy's float16 and int8 matrix products are slower
+    ### than float32 BLAS, so weights are expanded back to float32 once at load time.
+    return [p.astype('float32') if s is None else p.astype('float32') * s 
+            for p, s in zip(params, scales)]
+
+def save_quantized(model_fp, save_fp, precision):
+    npzfile = np.load(model_fp)
+    q_params, scales = quantize_params(npzfile['params'], precision)
+    np.savez(save_fp, net_opts=npzfile['net_opts'], 
+                      class_name=npzfile['class_name'], 
+                      params=q_params, 
+                      scales=scales, 
+                      precision=precision)
+
+#===== MODELS =====#
+
+class NumpyModel(object):
+    """
+    Deterministic forward pass of a model trained with models.py, evaluated
+    with NumPy from the saved .npz file. Dropout is left out, as it is at
+    test time.
+    """
+    def __init__(self, net_opts, params, fp=None):
+        self.net_opts = net_opts
+        self.fp = fp
+        self.params = [np.asarray(p) for p in params]
+        self.build_network()
+
+    def build_network(self):
+        # MUST BE OVERRIDDEN
+        self.layers = []
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+    def run(self, feature_list, batch_size=64, mem_budget=None):
+        """
+        Predict (feature, file_name) tuples in fixed-shape float32 batches
+        (see stack_batches). The seconds spent on each batch are kept in
+        self.batch_times.
+        """
+        pred_list = []
+        self.batch_times = []
+        for batch, n_valid in stack_batches(feature_list, batch_size, mem_budget):
+            start_time = time.time()
+            pred_list.append(self.forward(batch)[:n_valid])
+            self.batch_times.append(time.time() - start_time)
+        pred_list = np.concatenate(pred_list) if pred_list else np.array([])
+        return pred_list
+
+    def take_params(self, n):
+        p, self.params = self.params[:n], self.params[n:]
+        return p
+
+    def add_batch_norm(self):
+        beta, gamma, mean, inv_std = self.take_params(4)
+        self.layers.append(lambda x: batch_norm(x, beta, gamma, mean, inv_std))
+
+    def add_conv(self, layer_name, pad=0):
+        W, b = self.take_params(2)
+        stride = self.net_opts[layer_name]['stride']
+        self.layers.append(lambda x: rectify(conv1d(x, W, b, stride, pad)))
+
+    def add_pool(self, layer_name):
+        opts = self.net_opts[layer_name]
+        if opts['mode'] not in POOL_MODES:
+            raise NotImplementedError('No NumPy pooling for mode {} of {}.'.format(opts['mode'], layer_name))
+        self.layers.append(lambda x: pool1d(x, opts['pool_size'], opts['mode']))
+
+    def add_dense(self, nonlinearity=rectify):
+        W, b = self.take_params(2)
+        self.layers.append(lambda x: nonlinearity(dense(x, W, b)))
+
+    @staticmethod
+    def init_from_file(model_fp):
+        npzfile = np.load(model_fp)
+        class_name = npzfile['class_name'].item()
+        if class_name not in globals():
+            raise NotImplementedError('No NumPy inference for {}.'.format(class_name))
+        params = npzfile['params']
+        if 'precision' in npzfile.files:
+            params = dequantize_params(params, npzfile['scales'])
+        return globals()[class_name](npzfile['net_opts'].item(), params, model_fp)
+
+    @staticmethod
+    def load(model_fp):
+        """
+        Model of model_fp, built once per process and shared by later
+        calls. The file is reloaded when its modification time changes.
+        """
+        key = os.path.abspath(model_fp)
+        mtime = os.path.getmtime(model_fp)
+        with _REGISTRY_LOCK:
+            model = _MODEL_REGISTRY.get(key)
+            if model is None or model[0] != mtime:
+                model = (mtime, NumpyModel.init_from_file(model_fp))
+                _MODEL_REGISTRY[key] = model
+        return model[1]
+
+### Models loaded by NumpyModel.load(), as {abspath: (mtime, model)}
+_MODEL_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+
+##### MLP Network
+class NumpyDNNModel(NumpyModel):
+    def build_network(self):
+        self.layers = []
+        self.add_batch_norm()
+        for n in self.net_opts['layer_list']:
+            self.add_dense()
+        self.add_dense(softmax)
+
+##### CNN
+class NumpyCNNModel(NumpyModel):
+    def build_network(self):
+        self.layers = []
+        self.add_batch_norm()
+        self.add_conv('conv_1')
+        self.add_pool('pool_1')
+        self.add_conv('conv_2')
+        self.add_pool('pool_2')
+        for n in self.net_opts['layer_list']:
+            self.add_dense()
+        self.add_dense(softmax)
+
+##### Distilled CNN
+class NumpyStudentCNNModel(NumpyModel):
+    def build_network(self):
+        self.layers = []
+        self.add_batch_norm()
+        self.add_conv('conv_1')
+        self.add_pool('pool_1')
+        for n in self.net_opts['layer_list']:
+            self.add_dense()
+        self.add_dense(softmax)
+
+### Same names as in models.py, so that class_name in a model file picks the matching network
+class MFCCDNNModel(NumpyDNNModel, MFCCFeature): pass
+class SpecDNNModel(NumpyDNNModel, SpecFeature): pass
+class MFCCCNNModel(NumpyCNNModel, MFCCFeature): pass
+class SpecCNNModel(NumpyCNNModel, SpecFeature): pass
+class CocktailCNNModel(NumpyCNNModel, CocktailFeature): pass
+class MFCCStudentCNNModel(NumpyStudentCNNModel, MFCCFeature): pass
@@ -123,6 +123,19 @@ cnn_opts = {
     'num_class': NUM_CLASS,
 }
 
+### Small CNN distilled from a trained teacher (MFCCStudentCNNModel); 'teacher' is formatted
+### with the fold and direction of each student model file
+student_cnn_opts = {
+    'conv_1': { 'num_filters': 16, 'filter_size': 3, 'stride': 1, },
+    'pool_1': { 'pool_size': 2, 'mode': 'max', },
+    'layer_list': [32],
+    'dropout_p': 0.2,
+    'num_class': NUM_CLASS,
+    'teacher': 'model/cnn_mfcc/cnn_mfcc_{fold}.{direction}.npz',
+    'temperature': 4.0,
+    'soft_weight': 0.7,
+}
+
 cv_list =  [[5, 17, 32, 50, 55, 57, 58, 65, 70],
             [7, 13, 19, 21, 27, 51, 63, 66],
             [11, 15, 29, 40, 52, 59, 73],
@@ -1,5 +1,5 @@
 import numpy as np
-from note import Note
+from note import Note, NoteTable
 from technique import *
 from os import path
 
@@ -28,7 +28,7 @@ class Song:
 		return ts_list
 
 	def esn_matrix(self):
-		return np.array([esn.array_repr() for esn in detected_esns], dtype=float)
+		return NoteTable.from_notes(self.es_note_list).arr.copy()
 
 	def load_smooth_melody(self, file_path):
 		try:
@@ -44,14 +44,14 @@ class Song:
 
 	def load_note_list(self, file_path):
 		try:
-			raw_notes = np.loadtxt(file_path)
+			self.es_note_list = NoteTable.load(file_path, techs=False)
 		except IOError:
 			print('Note file {} does not exists!'.format(file_path))
-		self.es_note_list = np.array([Note(p, on, dur) for p, on, dur in raw_notes], dtype=object)
+			raise
 
 	def load_esn_list(self, file_path):
 		try:
-			esn_list = np.loadtxt(file_path)
+			self.es_note_list = NoteTable.load(file_path)
 		except IOError:
 			print('ES_Note file {} does not exists!'.format(file_path))
-		self.es_note_list = np.array([Note(array=esn) for esn in esn_list], dtype=object)
+			raise
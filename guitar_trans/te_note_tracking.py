@@ -1,10 +1,10 @@
 import numpy as np
-import operator
 import parameters as pm
 from contour import *
 from technique import *
 from note import *
 from scipy.stats import norm
+from multiprocessing import Pool
 from os import sep
 
 #=====Parameters=====#
@@ -52,13 +52,15 @@ def conditioned_mean_filter(data, filter_size=5):
     return new_data
 
 ### Technique Embedded Note Tracking
-def tent(melody, debug=None):
+def tent(melody, debug=None, n_jobs=1):
     if melody.length == 0:
         print 'Nothing in melody. (Length of melody is 0.)'
         return
     melody = Contour(melody.start_idx, 
-                     conditioned_norm_filter(melody.seq)
+                     conditioned_norm_filter(melody.seq),
+                     copy=False
                     )
+    melody.build_range_index()
     submelo_list = []
     sub_idx = 0
     submelo = []
@@ -72,7 +74,7 @@ def tent(melody, debug=None):
             submelo.append(melody[i])
         else:
             if len(submelo) >= min_melo_len:
-                ct = Contour(sub_idx, submelo)
+                ct = melody.view(sub_idx, sub_idx + len(submelo))
                 if len(submelo_list) > 0 and \
                    submelo_list[-1].end_idx + 1 == sub_idx and \
                    abs(submelo[0] - submelo_list[-1][-1]) < max_cand_diff:
@@ -85,22 +87,32 @@ def tent(melody, debug=None):
                 sub_idx = i
                 submelo.append(melody[i])
     if len(submelo) >= min_melo_len:
-        ct = Contour(sub_idx, submelo)
+        ct = melody.view(sub_idx, sub_idx + len(submelo))
         submelo_list.append(ct)
 
     trend = np.zeros(melody.length)
     if debug is not None: mid_trend = np.zeros(melody.length)
     # n_melo = melody.sub_contour(range(melody.length))
     notes = []
-    for idx, subm in enumerate(submelo_list):
-        tr = melody_2_trend(subm)
+    extrema = ExtremaIndex(melody.seq, [(s.start_idx, s.end_idx+1) for s in submelo_list])
+    jobs = [(s, extrema.sub(s.start_idx, s.end_idx+1)) for s in submelo_list]
+    ### Sub-melodies are tracked independently and linked in order below
+    if n_jobs == 1 or len(submelo_list) < 2:
+        results = map(_track_submelody, jobs)
+    else:
+        pool = Pool(n_jobs)
+        results = pool.map(_track_submelody, jobs)
+        pool.close()
+        pool.join()
+    for idx, (subm, (tr, nt)) in enumerate(zip(submelo_list, results)):
         if debug is not None: mid_trend[subm.start_idx:subm.start_idx+len(tr)] = list(tr)
-        nt = get_notes(subm, tr)
         ### Add candidate between submelodies
         if idx in melody_cand_dict.keys():
             sign, sub_idx = melody_cand_dict[idx]
             seg_pos = max(0, sub_idx - pm.MC_LENGTH/2 - notes[-1].onset)
-            seg = Segment(sign, seg_pos, pm.MC_LENGTH, melody)
+            ### seg_pos counts from the onset of the note, so the segment references the frames from there
+            onset = int(notes[-1].onset) - melody.start_idx
+            seg = Segment(sign, seg_pos, pm.MC_LENGTH, melody.view(onset, onset + seg_pos + pm.MC_LENGTH + 1))
             notes[-1].segs.append(seg)
             notes[-1].next_note = nt[0]
 
@@ -112,84 +124,259 @@ def tent(melody, debug=None):
         np.savetxt(debug+sep+'MidTrend.txt', mid_trend)
     return trend, melody, notes
 
-def melody_2_trend(melody):
-    extrema = get_extrema(melody.seq)
+def track_submelody(subm, extrema=None):
+    tr = melody_2_trend(subm, extrema)
+    nt = get_notes(subm, tr)
+    return tr, nt
+
+def _track_submelody(args):
+    return track_submelody(*args)
+
+class TentTracker(object):
+    """
+    Incremental version of tent() for live transcription.
+
+    Frames of the (unfiltered) melody contour are pushed in blocks. A
+    sub-melody is tracked as soon as a discontinuity closes it, and push()
+    returns the notes finished so far as (note, cands) pairs, where cands is
+    the list of (direction, seg) classification candidates of the note.
+    Frame indices count from the first pushed frame, as in tent().
+
+    Only the raw frames needed by conditioned_norm_filter() and the filtered
+    frames from the earliest open note (the held note or the open
+    sub-melody) on are kept, so memory does not grow with the input. The
+    last note of a sub-melody is held back until the next sub-melody decides
+    whether a candidate links them, so it is returned one sub-melody later.
+
+    Example
+    -------
+    tracker = TentTracker()
+    for block in blocks:
+        for note, cands in tracker.push(block):
+            ...
+    for note, cands in tracker.flush():
+        ...
+    """
+    def __init__(self):
+        self.h_fil = len(nf_weights) / 2
+        self.n_raw = 0      # number of raw frames received
+        self.n_done = 0     # number of frames filtered and segmented
+        self.raw = []       # raw frames from raw_start
+        self.raw_start = 0
+        self.melo = []      # filtered frames from melo_start
+        self.melo_start = 0
+        self.sub_idx = 0    # open sub-melody, melo frames [sub_idx, sub_idx + sub_len)
+        self.sub_len = 0
+        self.held = None    # (last note, end_idx and last value of its sub-melody)
+
+    def push(self, frames):
+        """
+        Add frames and return the list of (note, cands) finished by them.
+        """
+        self.raw += list(frames)
+        self.n_raw += len(frames)
+        return list(self.__process(self.n_raw - self.h_fil))
+
+    def flush(self):
+        """
+        Close the input and return the list of the remaining (note, cands).
+        """
+        out = list(self.__process(self.n_raw))
+        if self.sub_len >= min_melo_len:
+            ### The last sub-melody is never a candidate, as in tent()
+            out += self.__track(self.__submelody(), None)
+        self.sub_len = 0
+        out += self.__release()
+        self.__trim()
+        return out
+
+    def track(self, blocks):
+        for block in blocks:
+            for out in self.push(block):
+                yield out
+        for out in self.flush():
+            yield out
+
+    def __frame(self, i):
+        return self.melo[i - self.melo_start]
+
+    def __submelody(self):
+        st = self.sub_idx - self.melo_start
+        return Contour(self.sub_idx, self.melo[st:st + self.sub_len])
+
+    def __process(self, stop):
+        if stop <= self.n_done: return
+        ### Filter with h_fil frames of history, so the result equals the batch filter
+        lo = max(0, self.n_done - self.h_fil)
+        window = np.array(self.raw[lo - self.raw_start:], dtype=float)
+        filtered = conditioned_norm_filter(window)[self.n_done - lo:stop - lo]
+        new_start = max(0, stop - self.h_fil)
+        self.raw = self.raw[new_start - self.raw_start:]
+        self.raw_start = new_start
+        self.melo += list(filtered)
+
+        for i, val in enumerate(filtered, self.n_done):
+            if self.sub_len == 0:
+                if val >= min_pitch:
+                    self.sub_idx, self.sub_len = i, 1
+            elif abs(val - self.__frame(i - 1)) <= max_cont_diff:
+                self.sub_len += 1
+            else:
+                for out in self.__close():
+                    yield out
+                if val >= min_pitch:
+                    self.sub_idx, self.sub_len = i, 1
+                else:
+                    self.sub_len = 0
+                    for out in self.__release():
+                        yield out
+        self.n_done = stop
+        self.__trim()
+
+    def __trim(self):
+        ### Drop the frames before the earliest open note
+        keep = self.sub_idx if self.sub_len > 0 else self.n_done
+        if self.held is not None:
+            keep = min(keep, int(self.held[0].onset))
+        if keep > self.melo_start:
+            self.melo = self.melo[keep - self.melo_start:]
+            self.melo_start = keep
+
+    def __close(self):
+        if self.sub_len < min_melo_len:
+            return self.__release()
+        cand = None
+        if self.held is not None:
+            _, end_idx, last_val = self.held
+            first_val = self.__frame(self.sub_idx)
+            if end_idx + 1 == self.sub_idx and \
+               abs(first_val - last_val) < max_cand_diff:
+                ### Select as Candidate
+                sign = 1 if first_val >= last_val else -1
+                cand = (sign, self.sub_idx)
+        return self.__track(self.__submelody(), cand)
+
+    def __track(self, subm, cand):
+        out = []
+        subm.build_range_index()
+        _, nt = track_submelody(subm)
+        if self.held is not None and cand is not None:
+            ### Add candidate between submelodies
+            sign, sub_idx = cand
+            note = self.held[0]
+            seg_pos = max(0, sub_idx - pm.MC_LENGTH/2 - note.onset)
+            ### Reference the frames from the onset of the note, as tent() does
+            st = int(note.onset) - self.melo_start
+            ref_con = Contour(note.onset, self.melo[st:st + seg_pos + pm.MC_LENGTH + 1])
+            note.segs.append(Segment(sign, seg_pos, pm.MC_LENGTH, ref_con))
+            note.next_note = nt[0]
+        out += self.__release()
+        out += [self.__emit(note) for note in nt[:-1]]
+        self.held = (nt[-1], subm.end_idx, subm[-1])
+        return out
+
+    def __release(self):
+        if self.held is None:
+            return []
+        note = self.held[0]
+        self.held = None
+        return [self.__emit(note)]
+
+    @staticmethod
+    def __emit(note):
+        cands = [(pm.D_ASCENDING if seg.val >= 0 else pm.D_DESCENDING, seg) for seg in note.segs]
+        return note, cands
+
+def melody_2_trend(melody, extrema=None):
+    """
+    extrema: np.ndarray, rows of ExtremaIndex for this melody, found here if None
+    """
+    if extrema is None:
+        extrema = ExtremaIndex(melody.seq, [(0, melody.length)], melody.start_idx).arr
     ### If the difference in this melody is smaller than min_vib_amp, 
     ### return a single, nontechnical note.
     if max(extrema[:,1]) - min(extrema[:,1]) < min_vib_amp:
         return [0] * melody.length
 
     ### Record the trend (ascending, descending, or horizontal)
-    trend = np.zeros(melody.length)
-    for i in range(len(extrema)-1):
-        j, j_val, _ = extrema[i]
-        k, k_val, _ = extrema[i+1]
-        j, k = int(j), int(k)
-        pattern = Contour(j, melody[j:k])
-        trend[j:k] = scan_pattern_trend(pattern, melody[int(k)])
+    trend = scan_trend(melody.seq, extrema[:,0].astype(int) - melody.start_idx)
     trend[-1] = trend[-2] 
     return trend
 
+def scan_trend(seq, ext_idx, alpha=0.5):
+    """
+    Trace the patterns between each pair of adjacent extrema that are possible
+    to find techs and highlight their parts of slope, all patterns at once.
+
+    Parameters
+    ----------
+    seq: np.ndarray, the melody
+    ext_idx: np.ndarray, sorted indices of the extrema on seq
+    alpha: float, ratio of the average slope of a pattern that a step must exceed
+
+    Returns
+    -------
+    trend: np.ndarray, 1 on ascending slopes, -1 on descending slopes and 0 
+           elsewhere, including the part after the last extremum
+    """
+    seq = np.asarray(seq, dtype=float)
+    ext_idx = np.asarray(ext_idx, dtype=int)
+    delta = np.zeros(len(seq) + 1)
+    if len(ext_idx) < 2:
+        return delta[:-1]
+    head, tail = ext_idx[:-1], ext_idx[1:]
+    length = tail - head
+    pattern_diff = seq[tail] - seq[head]
+    trend_type = np.where(pattern_diff >= 0, 1.0, -1.0)
+    slope = alpha * pattern_diff / length
+    plain_thres = np.minimum(length // 3, 18)
+    active = (np.abs(pattern_diff) >= min_vib_amp) & (plain_thres > 0)
+
+    ### Find steps m -> m+1 inside a pattern with slope larger than average slope
+    pid = np.repeat(np.arange(len(head)), length)
+    m = np.arange(head[0], tail[-1])
+    steep = active[pid] & (m + 1 < tail[pid]) & \
+            (trend_type[pid] * (seq[m+1] - seq[m]) > trend_type[pid] * slope[pid])
+    m, pid = m[steep], pid[steep]
+    if len(m) == 0:
+        return delta[:-1]
+
+    ### Steep steps separated by less than plain_thres plain steps form one slope
+    first = np.r_[True, (pid[1:] != pid[:-1]) | (m[1:] - m[:-1] - 1 >= plain_thres[pid[1:]])]
+    first = np.flatnonzero(first)
+    last = np.r_[first[1:] - 1, len(m) - 1]
+    pid = pid[first]
+    start_m, end_m = m[first], m[last] + 1
+    ### The last slope of a pattern is still open if the plain part after it is short,
+    ### and then lasts until the next extremum.
+    accu_plain = tail[pid] - 1 - end_m
+    is_open = np.r_[pid[1:] != pid[:-1], True] & (accu_plain < plain_thres[pid])
+    keep = np.where(is_open,
+                    np.abs(seq[tail[pid]] - seq[start_m]) >= min_vib_amp,
+                    np.abs(seq[end_m] - seq[start_m]) >= min_cs_amp)
+    end_m = np.where(is_open, tail[pid], end_m)
+    np.add.at(delta, start_m[keep], trend_type[pid[keep]])
+    np.add.at(delta, end_m[keep], -trend_type[pid[keep]])
+    return np.cumsum(delta)[:-1]
+
 def scan_pattern_trend(pattern, next_extreme, alpha=0.5):
-    pattern_diff = next_extreme - pattern[0]
-    trend = [0] * pattern.length
-    ### Trace the pattern that is possible to find techs and highlight the part of slope
-    if (abs(pattern_diff) >= min_vib_amp):
-        ### Decide the direction of pattern
-        if pattern_diff >= 0: ### ascending pattern
-            trend_type = 1
-            opt = operator.gt
-        elif pattern_diff < 0: ### descending pattern
-            trend_type = -1
-            opt = operator.lt
-        else:
-            raise ValueError("Direction must either be \'up\' or \'down\'")
-
-        ### Find place with slope larger than average slope
-        slope = alpha * pattern_diff / pattern.length
-        accu_plain = 0
-        trend = [0] * pattern.length
-        plain_thres = min(pattern.length/3, 18)
-        m = end_m = start_m = 0
-        while m < pattern.length-1:
-            if opt(pattern[m+1] - pattern[m], slope):
-                end_m = m + 1
-                if accu_plain > 0: 
-                    accu_plain = 0
-            else:
-                accu_plain += 1
-                if accu_plain == plain_thres:
-                    if end_m > start_m and \
-                       abs(pattern[end_m] - pattern[start_m]) >= min_cs_amp:
-                        trend[start_m:end_m] = [trend_type] * (end_m  - start_m)
-                    start_m = end_m
-                if end_m == start_m:
-                    start_m = end_m = m + 1
-            m += 1
-        if accu_plain < plain_thres and abs(next_extreme - pattern[start_m]) >= min_vib_amp:
-            end_m = pattern.length
-            trend[start_m:end_m] = [trend_type] * (end_m  - start_m)
-    return trend
+    seq = np.r_[pattern, next_extreme]
+    return scan_trend(seq, [0, len(pattern)], alpha)[:-1]
 
 def get_notes(melody, trend):
     ### Merge segments
-    seg_melo = SegmentedContour(melody.start_idx, melody.seq, trend)
+    seg_melo = SegmentedContour(melody.start_idx, melody.seq, trend, copy=False,
+                                range_index=melody.range_index)
     if seg_melo.n_segs > 0:
         ### Fill some small zero holes in some trends
-        all_segs = seg_melo.all_segs(sort=True)
-        s = all_segs[0]
-        for ns in all_segs[1:]:
-            if ns.val == s.val and \
-               ns.pos - s.end < min_pattern_length:
-                seg_melo.merge_segs([s.pos, ns.pos])
-            else:
-                s = ns
-        
+        seg_melo.merge_close_segs(min_pattern_length)
+
+        edge_segs = []
         for seg in seg_melo.all_segs():
             ### Some trends that happened in the head or tail of a submelody
             ### should be considered from melody scale, not here.
             if seg.mid < 10 or seg_melo.length - seg.mid < 10:
-                seg_melo.delete_seg(seg)
+                edge_segs.append(seg)
                 continue
 
             ### Check special techniques
@@ -203,6 +390,7 @@ def get_notes(melody, trend):
                     seg.val *= T_SLIDE
             elif ct.length >= 30:
                 seg.val *= T_BEND
+        seg_melo.delete_segs(edge_segs)
 
     ### Split the trend if there are several possible notes in this trend.
     notes = []
@@ -220,7 +408,7 @@ def get_notes(melody, trend):
              np.sign(all_segs[i].val) == np.sign(all_segs[i+1].val) and \
              abs(all_segs[i+1].val) not in (T_SLIDE_IN, T_SLIDE_OUT):
             cands.append(seg_melo.start_idx + all_segs[i].pos)
-            contour = seg_melo.sub_contour(range(start_point, all_segs[i].end))
+            contour = seg_melo.sub_view(start_point, all_segs[i].end)
             notes += estimate_notes(contour, cands, slide_in, slide_out)
             trend[start_point:all_segs[i].end] = contour.get_trend()
             start_point = all_segs[i].end
@@ -228,7 +416,7 @@ def get_notes(melody, trend):
             slide_in = -1
         else:
             cands.append(seg_melo.start_idx + all_segs[i].pos)
-    contour = seg_melo.sub_contour(range(start_point, seg_melo.length))
+    contour = seg_melo.sub_view(start_point, seg_melo.length)
     notes += estimate_notes(contour, cands, slide_in, slide_out)
     ### update the trend
     trend[start_point:seg_melo.length] = contour.get_trend()
@@ -267,26 +455,24 @@ def estimate_notes(melo, cands, slide_in, slide_out):
         return create_vibrato_note(melo, seg, slide_in, slide_out)
 
 def merge_notes(notes):
-    for i in range(len(notes)-1, 0, -1):
-        nt = notes[i-1]
-        ### Merge notes if there is bend or release
-        if (nt.tech(T_BEND).value > 0 and \
-            nt.offset == notes[i].onset and \
-            nt.pitch + nt.tech(T_BEND).value == notes[i].pitch) or \
-           (nt.tech(T_RELEASE).value > 0 and \
-            nt.offset == notes[i].onset and \
-            nt.pitch == notes[i].pitch):
-            notes[i-1] = CandidateNote.merge(nt, notes[i])
-            notes.remove(notes[i])
-        elif nt.tech(T_SLIDE).value == 1:
-            t_val = 3 if notes[i].tech(T_SLIDE).value in (1, 3) else 2
-            notes[i].add_tech(Tech(T_SLIDE, t_val))
-        elif nt.tech(T_HAMMER).value == 1:
-            t_val = 3 if notes[i].tech(T_HAMMER).value in (1, 3) else 2
-            notes[i].add_tech(Tech(T_HAMMER, t_val))
-        elif nt.tech(T_PULL).value == 1:
-            t_val = 3 if notes[i].tech(T_PULL).value in (1, 3) else 2
-            notes[i].add_tech(Tech(T_PULL, t_val))
+    if len(notes) < 2: return
+    table = NoteTable.from_notes(notes)
+    pitch, bend, release = table.pitch, table.tech_values(T_BEND), table.tech_values(T_RELEASE)
+    ### Merge notes if there is bend or release
+    linked = (table.offset[:-1] == table.onset[1:]) & \
+             (((bend[:-1] > 0) & (pitch[:-1] + bend[:-1] == pitch[1:])) | \
+              ((release[:-1] > 0) & (pitch[:-1] == pitch[1:])))
+    ### The last note before each merged note passes on its slide, hammer or pull
+    last = np.nonzero(~linked)[0]
+    src = table.arr[last]
+    table = table.merge(linked)
+    dst = table.arr[1:]
+    passed = np.zeros(len(last), dtype=bool)
+    for t_type in (T_SLIDE, T_HAMMER, T_PULL):
+        cond = ~passed & (src[:, t_type] == 1)
+        dst[cond, t_type] = np.where(np.in1d(dst[cond, t_type], (1, 3)), 3, 2)
+        passed |= cond
+    notes[:] = table.to_notes(CandidateNote)
 
 def has_slide_in(melo, slide_in):
     """
@@ -463,35 +649,57 @@ def get_note_with_seg(pitch, start_idx, length, techs, seg):
 
 
 
-def _generate_extrema(y, y_cond, etype):
-    ### Extract extrema from pruned matrix and add the extrema type to the matrix
-    e = y[np.extract(y_cond, range(len(y_cond)))]
-    ### np.full is faster than np.vstack
-    ext = np.full((e.shape[0], e.shape[-1]+1), float(etype))
-    ext[:,:-1] = e
-    return ext
+class ExtremaIndex(object):
+    """
+    Extrema of the sub-melodies of a melody, found in one vectorized pass.
+
+    Parameters
+    ----------
+    seq: np.ndarray, the melody
+    bounds: list of (start, end), the sub-melodies as seq[start:end]
+    start_idx: int, the index of seq[0]
+
+    Rows of arr are (index, value, type) sorted by index, where type is 1.0
+    for a maximum and -1.0 for a minimum. Neighbours are only compared
+    within a sub-melody, so the rows of a sub-melody are those get_extrema()
+    returns for it, with indices on the whole melody.
+    """
+    def __init__(self, seq, bounds, start_idx=0):
+        seq = np.asarray(seq, dtype=float)
+        bounds = np.asarray(bounds, dtype=int).reshape(-1, 2)
+        marks = np.zeros(len(seq) + 1, dtype=int)
+        np.add.at(marks, bounds[:,0], 1)
+        np.add.at(marks, bounds[:,1], -1)
+        head = np.zeros(len(seq), dtype=bool)
+        head[bounds[:,0]] = True
+        idx = np.flatnonzero(np.cumsum(marks)[:-1] > 0)
+        x, head = seq[idx], head[idx]
+        ### Shrink the part of continuous same values
+        prune_cond = head.copy()
+        prune_cond[1:] |= x[1:] != x[:-1]
+        w, e, h = idx[prune_cond], x[prune_cond], head[prune_cond]
+        t = np.r_[h[1:], True]
+        ### Extract max and min. A sub-melody of one value is a maximum.
+        max_cond = (h | np.r_[False, e[1:] > e[:-1]]) & (t | np.r_[e[1:] < e[:-1], False])
+        min_cond = (h | np.r_[False, e[1:] < e[:-1]]) & (t | np.r_[e[1:] > e[:-1], False]) & ~(h & t)
+        ext_cond = max_cond | min_cond
+        self.arr = np.empty((np.count_nonzero(ext_cond), 3))
+        self.arr[:,0] = w[ext_cond] + start_idx
+        self.arr[:,1] = e[ext_cond]
+        self.arr[:,2] = np.where(max_cond[ext_cond], 1.0, -1.0)
+
+    def __len__(self):
+        return len(self.arr)
+
+    def sub(self, start_idx, end_idx):
+        """
+        Extrema with start_idx <= index < end_idx, as a view of arr.
+        """
+        lo, hi = np.searchsorted(self.arr[:,0], [start_idx, end_idx])
+        return self.arr[lo:hi]
 
 def get_extrema(x):
     if len(x) == 0: 
         print 'Error in get_extrema: Length of x should not be zero.'
         return np.array([])
-    x = np.array(x)
-    ### Shrink the part of continuous same values
-    prune_cond = np.r_[True, x[1:] != x[:-1]]
-    w = np.argwhere(prune_cond).reshape(-1)
-    e = np.extract(prune_cond, x)
-    if len(e) == 1:
-        ### x contains only one value. Set the value to be a maximum.
-        return np.array([[0.0, e[0], 1.0]])
-    x_prune = np.array([w,e]).T
-    ### Extract max and min
-    max_cond = np.r_[True, x_prune[1:,-1] > x_prune[:-1,-1]] & \
-               np.r_[x_prune[1:,-1] < x_prune[:-1,-1], True]
-    x_max = _generate_extrema(x_prune, max_cond, 1.0)
-    min_cond = np.r_[True, x_prune[1:,-1] < x_prune[:-1,-1]] & \
-               np.r_[x_prune[1:,-1] > x_prune[:-1,-1], True]
-    x_min = _generate_extrema(x_prune, min_cond, -1.0)
-    ### Concatenate max min and sort with original args
-    x_ext = np.concatenate((x_max, x_min), axis=0)
-    x_ext = x_ext[x_ext[:,0].argsort()]
-    return x_ext
+    return ExtremaIndex(x, [(0, len(x))]).arr
@@ -21,6 +21,8 @@ T_STR_DICT = {  T_NORMAL: 'Normal',
 				T_VIBRATO: 'Vibrato'}
 
 class Tech(object):
+	__slots__ = ('t_type', 'value')
+
 	def __init__(self, t_type=T_NORMAL, value=0):
 		if t_type > T_NORMAL or t_type < T_PREBEND: 
 			print('ERROR: No Tech type {}. Will assign to normal type(12).'.format(t_type))
@@ -43,3 +45,36 @@ class Tech(object):
 
 	def __repr__(self):
 		return 'Tech(t_type: ' + T_STR_DICT[self.t_type] + '(' + str(self.t_type) + '), value: ' + str(self.value) + ')'
+
+	@staticmethod
+	def of(t_type, value):
+		"""
+		Shared, read-only Tech for the integral values 0..MAX_TECH_VALUE a
+		note can hold, keeping the type of value. Other values get a new Tech.
+		"""
+		key = (t_type, value, type(value))
+		tech = _TECH_CACHE.get(key)
+		if tech is None:
+			if not (0 <= value <= MAX_TECH_VALUE and value == int(value)):
+				return Tech(t_type, value)
+			tech = _TECH_CACHE.setdefault(key, _SharedTech(t_type, value))
+		return tech
+
+class _SharedTech(Tech):
+	"""
+	Tech returned by Tech.of(). One object is shared by every note with the
+	same tech, so it cannot be modified; create a Tech to change a value.
+	"""
+	__slots__ = ()
+
+	def __setattr__(self, name, value):
+		if hasattr(self, 'value'):
+			raise AttributeError('Tech objects from Tech.of() are shared and cannot be modified.')
+		super(_SharedTech, self).__setattr__(name, value)
+
+	def __reduce__(self):
+		return (_SharedTech, (self.t_type, self.value))
+
+MAX_TECH_VALUE = 12
+### {(t_type, value, type of value): _SharedTech}, filled by Tech.of()
+_TECH_CACHE = {}
@@ -2,7 +2,8 @@ import librosa as rosa
 import numpy as np
 import guitar_trans.te_note_tracking as note_tracking
 import guitar_trans.parameters as pm
-from guitar_trans import models
+from guitar_trans import features, np_models
+from guitar_trans.gating import ContourGate
 from guitar_trans.song import *
 from guitar_trans.note import *
 from guitar_trans.contour import *
@@ -10,30 +11,31 @@ from guitar_trans.technique import *
 from guitar_trans.evaluation import evaluation_note, evaluation_esn, evaluation_ts
 from melody_extraction import extract_melody
 from os import path, sep, makedirs
+from multiprocessing.pool import ThreadPool
 
 N_BIN = int(round(0.14 * 44100))
 N_FRAME = pm.MC_LENGTH
 
-def transcribe(audio, melody, asc_model_fp, desc_model_fp, save_dir, audio_fn):
+def transcribe(audio, melody, asc_model_fp, desc_model_fp, save_dir, audio_fn, n_jobs=1, gate_fp=None):
     if not path.exists(save_dir): makedirs(save_dir)
     print '  Output directory: ', '\n', '    ', save_dir
-    trend, new_melody, notes = note_tracking.tent(melody, debug=save_dir)
+    trend, new_melody, notes = note_tracking.tent(melody, debug=save_dir, n_jobs=n_jobs)
     np.savetxt(save_dir+sep+'FilteredMelody.txt', new_melody.seq, fmt='%.8f')
-    np.savetxt(save_dir+sep+'TentNotes.txt', [n.discrete_to_cont(pm.HOP_LENGTH, pm.SAMPLING_RATE).array_repr() for n in notes], fmt='%.8f')
+    NoteTable.from_notes(notes).to_time(pm.HOP_LENGTH, pm.SAMPLING_RATE).save(save_dir+sep+'TentNotes.txt')
     cand_dict = {pm.D_ASCENDING: [], pm.D_DESCENDING: []}
     cand_ranges = []
     rate = float(pm.HOP_LENGTH) / float(pm.SAMPLING_RATE)
     cand_results = []
     for nt in notes:
-        if nt.tech(T_BEND).value > 0:
+        if nt.tech_value(T_BEND) > 0:
             cand_results.append([nt.onset * rate, nt.offset * rate, T_BEND])
-        if nt.tech(T_RELEASE).value > 0:
+        if nt.tech_value(T_RELEASE) > 0:
             cand_results.append([nt.onset * rate, nt.offset * rate, -T_RELEASE])
-        if nt.tech(T_SLIDE_IN).value > 0:
+        if nt.tech_value(T_SLIDE_IN) > 0:
             cand_results.append([nt.onset * rate, nt.offset * rate, T_SLIDE_IN])
-        if nt.tech(T_SLIDE_OUT).value > 0:
+        if nt.tech_value(T_SLIDE_OUT) > 0:
             cand_results.append([nt.onset * rate, nt.offset * rate, T_SLIDE_OUT])
-        if nt.tech(T_VIBRATO).value > 0:
+        if nt.tech_value(T_VIBRATO) > 0:
             cand_results.append([nt.onset * rate, nt.offset * rate, T_VIBRATO])
         for seg in nt.segs:
             mid_frame = nt.onset + seg.mid
@@ -48,18 +50,34 @@ def transcribe(audio, melody, asc_model_fp, desc_model_fp, save_dir, audio_fn):
             direction = pm.D_ASCENDING if seg.val >= 0 else pm.D_DESCENDING
             cand_dict[direction].append((sub_audio, sub_mc, sub_fn, nt, seg, start_i, end_i))
             # rosa.output.write_wav('trans/audio/clip_'+sub_fn+'.wav', sub_audio, sr=pm.SAMPLING_RATE, norm=False)
+    song_feat = features.SongFeatures(audio)
+    gate = ContourGate.load(gate_fp) if gate_fp is not None else None
+    ### Models are loaded here, as Theano models must not be compiled in two threads at once
+    model_dict = {direction: load_model(asc_model_fp if direction == pm.D_ASCENDING else desc_model_fp)
+                  for direction in cand_dict if len(cand_dict[direction]) > 0}
+    ### Both directions are classified at the same time; their results are applied in order below
+    pool = ThreadPool(len(cand_dict))
+    try:
+        pred_dict = {}
+        for direction in model_dict:
+            pred_dict[direction] = pool.apply_async(predict_candidates, 
+                                                    (direction, cand_dict[direction], model_dict[direction], song_feat, gate))
+        pred_dict = {direction: res.get() for direction, res in pred_dict.items()}
+    finally:
+        pool.close()
+        pool.join()
     no_next = []
+    note_seq = NoteSequence(notes)
     for direction in cand_dict:
         print 'Processing direction', direction
         cand_list = cand_dict[direction]
-        model_fp = asc_model_fp if direction == pm.D_ASCENDING else desc_model_fp
         if len(cand_list) > 0:
-            pred_list = classification(model_fp, [cand[:3] for cand in cand_list])
+            pred_list = pred_dict[direction]
             for pred, cand in zip(pred_list, cand_list):
                 sub_audio, sub_mc, sub_fn, nt, seg, start_i, end_i = cand
                 t_name = pm.inv_tech_dict[direction][np.argmax(pred)]
                 t_type = get_tech(t_name, direction)
-                origin_t_val = nt.tech(t_type).value
+                origin_t_val = nt.tech_value(t_type)
                 t_val = int(round(seg.diff())) if t_type in (T_BEND, T_RELEASE) else origin_t_val + 1
                 if t_type < T_NORMAL:
                     ### Merge Notes
@@ -74,11 +92,11 @@ def transcribe(audio, melody, asc_model_fp, desc_model_fp, save_dir, audio_fn):
                         #     print cand[4]
                         #     t_type = T_BEND if direction == pm.D_ASCENDING else T_RELEASE
                     elif t_type in [T_BEND, T_RELEASE]:
-                        if nt.next_note in notes:
-                            notes.remove(nt.next_note)
+                        if nt.next_note in note_seq:
+                            note_seq.remove(nt.next_note)
                         nt.merge_note(nt.next_note)
                     elif t_type in [T_HAMMER, T_PULL, T_SLIDE]:
-                        tv = nt.next_note.tech(t_type).value
+                        tv = nt.next_note.tech_value(t_type)
                         nt.next_note.add_tech(Tech(t_type, tv+2))
                     nt.add_tech(Tech(t_type, t_val))
                 sign = 1 if direction == pm.D_ASCENDING else -1 
@@ -86,13 +104,40 @@ def transcribe(audio, melody, asc_model_fp, desc_model_fp, save_dir, audio_fn):
     np.savetxt(save_dir+sep+'NoNextNote.txt', no_next, fmt='%.8f')
     np.savetxt(save_dir+sep+'CandidateResults.txt', cand_results, fmt='%.8f')
     # note.merge_notes(notes)
-    cont_notes = [nt.discrete_to_cont(pm.HOP_LENGTH, pm.SAMPLING_RATE) for nt in notes]
-    np.savetxt(save_dir+sep+'FinalNotes.txt', [n.array_repr() for n in cont_notes], fmt='%.8f')
-    return cont_notes
+    cont_notes = NoteTable.from_notes(note_seq).to_time(pm.HOP_LENGTH, pm.SAMPLING_RATE)
+    cont_notes.save(save_dir+sep+'FinalNotes.txt')
+    return cont_notes.to_notes()
             
-def classification(model_fp, cand_list):
-    model = models.Model.init_from_file(model_fp)
-    data_list = [model.extract_features(*(cand[:3])) for cand in cand_list]
+def predict_candidates(direction, cand_list, model, song_feat, gate=None):
+    ### Class probabilities of the candidates of one direction; those the contour gate is confident about skip the CNN
+    pred_list = np.zeros((len(cand_list), pm.NUM_CLASS))
+    to_cnn = np.ones(len(cand_list), dtype=bool)
+    if gate is not None and direction in gate.params:
+        ### The gate is fitted on windows with filled unvoiced ends (see calibrate_gate.py); fill copies, as sub_mc is a view of the melody
+        mc_list = [features.fit_melody_window(np.array(cand[1], dtype='float32')) for cand in cand_list]
+        confident, gate_pred = gate.decide(direction, mc_list)
+        pred_list[confident] = gate_pred[confident]
+        to_cnn = ~confident
+        print '  Gate labeled {} of {} {} candidates.'.format(confident.sum(), len(cand_list), direction)
+    if to_cnn.any():
+        pred_list[to_cnn] = classification(model, [cand[:3] + cand[5:6] for cand, c in zip(cand_list, to_cnn) if c], 
+                                           song_feat)
+    return pred_list
+
+def load_model(model_fp):
+    try:
+        return np_models.NumpyModel.load(model_fp)
+    except NotImplementedError:
+        ### Raw audio networks still run through Theano
+        from guitar_trans import models
+        return models.Model.load(model_fp)
+
+def classification(model, cand_list, song_feat=None):
+    if song_feat is None:
+        data_list = [model.extract_features(*(cand[:3])) for cand in cand_list]
+    else:
+        data_list = [model.extract_song_features(song_feat, start_i, N_BIN, sub_mc, sub_fn) 
+                     for sub_audio, sub_mc, sub_fn, start_i in cand_list]
     pred_list = model.run(data_list)
     return pred_list   
 
@@ -112,7 +157,7 @@ def get_tech(t_name, direction):
     else:
         raise ValueError("t_name shouldn't be {}.".format(t_name))
 
-def main(audio_fp, asc_model_fp, desc_model_fp, output_dir, mc_fp=None, eval_note=None, eval_ts=None):
+def main(audio_fp, asc_model_fp, desc_model_fp, output_dir, mc_fp=None, eval_note=None, eval_ts=None, n_jobs=1, gate_fp=None):
     audio_fn = path.splitext(path.basename(audio_fp))[0]
     save_dir = path.join(output_dir, audio_fn)
     if mc_fp is None:
@@ -121,7 +166,7 @@ def main(audio_fp, asc_model_fp, desc_model_fp, output_dir, mc_fp=None, eval_not
         mc_midi = np.loadtxt(mc_fp)
     audio, sr = rosa.load(audio_fp, sr=None, mono=True)
     melody = Contour(0, mc_midi)
-    notes = transcribe(audio, melody, asc_model_fp, desc_model_fp, save_dir, audio_fn)
+    notes = transcribe(audio, melody, asc_model_fp, desc_model_fp, save_dir, audio_fn, n_jobs, gate_fp)
     if eval_note is not None:
         sg = Song(name=audio_fn)
         sg.load_esn_list(eval_note)
@@ -154,10 +199,14 @@ Script for transcribing a song.
                     help='The filepath of melody contour.')
     p.add_argument('-e', '--evaluate', type=str, default=None, 
                     help='The filepath of answer file.')
+    p.add_argument('-j', '--n_jobs', type=int, default=1,
+                    help='The number of processes for note tracking. 0 uses all CPUs.')
+    p.add_argument('-g', '--gate_fp', type=str, default=None,
+                    help='The filepath of a contour gate saved by calibrate_gate.py. Candidates it is confident about skip the CNN.')
     return p.parse_args()
 
 if __name__ == '__main__':
     args = parser()
     main(args.audio_fp, args.asc_model_fp, args.desc_model_fp, 
-         args.output_dir, args.melody_contour, args.evaluate)
+         args.output_dir, args.melody_contour, args.evaluate, n_jobs=args.n_jobs or None, gate_fp=args.gate_fp)
 
@@ -1,10 +1,14 @@
+import sys, os
+if __name__ == '__main__':
+    ### Before numpy and Theano load BLAS
+    from blas_threads import set_blas_threads
+    set_blas_threads(sys.argv[1:])
 from guitar_trans import models
 from guitar_trans import parameters as pm
 import classification as clf
 import numpy as np
-import sys, os
 
-def main(model_name, model_type, model_opts, data_dir, iteration, sep_direction=True, test_aug=False, description=None):
+def main(model_name, model_type, model_opts, data_dir, iteration, sep_direction=True, test_aug=False, description=None, n_jobs=1):
     results = {}
     for key in [pm.D_ASCENDING, pm.D_DESCENDING]:
         results[key] = np.zeros((pm.NUM_CLASS, pm.NUM_CLASS), dtype=int)
@@ -14,28 +18,31 @@ def main(model_name, model_type, model_opts, data_dir, iteration, sep_direction=
     mc_dir = os.path.join(data_dir, 'melody')
     model_class = getattr(models, model_type)
     param_set = getattr(pm, model_opts)
-    output_dir = clf.output_dir
-    clf.model_dir = os.path.join(clf.model_dir, model_name)
-    clf.output_dir = os.path.join(clf.output_dir, model_name)
-    if not os.path.isdir(clf.model_dir):
-        os.mkdir(clf.model_dir)
-    if not os.path.isdir(clf.output_dir):
-        os.mkdir(clf.output_dir)
+    ### Each iteration keeps its models and scores under <dir>/<model_name>/<model_name>_<i>
+    run_model_dir = os.path.join(clf.model_dir, model_name)
+    run_output_dir = os.path.join(clf.output_dir, model_name)
     ### load and pre-process input features
     feature_bank = clf.load_n_preprocess_input_feature(audio_dir, mc_dir, model_class, sep_direction)
     # np.save('feature_bank_spec+mc.npy', feature_bank)
     # feature_bank = np.load('feature_bank_mfcc.npy').item()
     print('Run {} iterations.'.format(iteration))
-    for i in range(iteration):
+    iter_names = [model_name + '_' + str(i) for i in range(iteration)]
+    jobs = []
+    for name in iter_names:
+        jobs += clf.fold_jobs(feature_bank, name, model_class, param_set, sep_direction=True, test_aug=False, 
+                              run_model_dir=run_model_dir, run_output_dir=run_output_dir)
+    fold_results = clf.run_fold_jobs(feature_bank, jobs, n_jobs)
+    for i, name in enumerate(iter_names):
         print('iteration: {}'.format(i))
-        cm = clf.classify(feature_bank, model_name + '_' + str(i), model_class, param_set, sep_direction=True, test_aug=False)
+        cm = clf.collect_fold_results(fold_results, feature_bank.keys(), name, sep_direction=True, 
+                                      run_output_dir=run_output_dir)
         for key in cm:
             if key in results:
                 results[key] += cm[key]
     for key in results:
         print('Final result of {}'.format(key))
         csv_fn = 'evaluation.' + key + '.csv'
-        save_fp = os.path.join(output_dir, model_name, csv_fn)
+        save_fp = os.path.join(run_output_dir, csv_fn)
         clf.eval_scores(results[key], key, print_scores=True, save_fp=save_fp)
 
 def parser():
@@ -61,10 +68,12 @@ Script for training guitar playing technique classification models for several r
                     help='The description of this model.')
     p.add_argument('-i', '--iteration', type=int, default=10,
                     help='The description of this model.')
+    p.add_argument('-j', '--n_jobs', type=int, default=1,
+                    help='The number of processes training folds of all iterations in parallel (0 for all CPUs).')
 
     return p.parse_args()
 
 if __name__ == '__main__':
     args = parser()
-    main(args.model_name, args.model_type, args.model_opts, args.data_dir, args.iteration, description=args.description)
+    main(args.model_name, args.model_type, args.model_opts, args.data_dir, args.iteration, description=args.description, n_jobs=args.n_jobs or None)
 
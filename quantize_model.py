@@ -0,0 +1,79 @@
+"""
+--------------------------------------------------------------------------------
+Script for converting trained classification models to float16 or int8
+weights, and for measuring the accuracy each precision loses. The conversion
+only makes the model files smaller: inference runs in float32.
+--------------------------------------------------------------------------------
+"""
+import os
+import numpy as np
+from guitar_trans import np_models
+from guitar_trans import parameters as pm
+from sklearn.metrics import confusion_matrix
+
+def model_fold(model_fp):
+    ### Model files of classification.classify() are named <model_name>_<fold>.<direction>.npz
+    name, direction = os.path.basename(model_fp).split('.')[:2]
+    return int(name.split('_')[-1]), direction
+
+def precision_model(model_fp, precision):
+    ### The model of model_fp with its weights rounded to precision, as if loaded from a converted file
+    npzfile = np.load(model_fp)
+    q_params, scales = np_models.quantize_params(npzfile['params'], precision)
+    model_class = getattr(np_models, npzfile['class_name'].item())
+    return model_class(npzfile['net_opts'].item(), np_models.dequantize_params(q_params, scales), model_fp), \
+           sum(p.nbytes for p in q_params) + sum(s.nbytes for s in scales if s is not None)
+
+def report(model_fp, feature_bank_fp):
+    import classification as clf
+    fold, direction = model_fold(model_fp)
+    feature_bank = np.load(feature_bank_fp).item()
+    test_list = [t for t in feature_bank[direction][fold] if 'aug' not in t[-1]]
+    print('Test on fold {} of {} ({} data).'.format(fold, direction, len(test_list)))
+    row_format = "{:>10}" + "{:>14}" * 5
+    print(row_format.format('Precision', 'Weight bytes', 'Accuracy', 'Acc. drop', 'F1 drop', 'Max prob diff'))
+    for precision in np_models.PRECISIONS:
+        model, n_bytes = precision_model(model_fp, precision)
+        pred = model.run(test_list)
+        cm = confusion_matrix([np.argmax(t[-2]) for t in test_list], np.argmax(pred, axis=1), labels=range(pm.NUM_CLASS))
+        acc = 100. * np.trace(cm) / np.sum(cm)
+        f1 = float(clf.eval_scores(cm, direction, print_scores=False)[-1][3])
+        if precision == 'float32':
+            base_pred, base_acc, base_f1 = pred, acc, f1
+        print(row_format.format(precision, n_bytes, '{:.2f} %'.format(acc), '{:+.2f} %'.format(base_acc - acc),
+                                '{:+.4f}'.format(base_f1 - f1), '{:.2e}'.format(np.abs(pred - base_pred).max())))
+
+def main(model_fp, precision, save_fp=None, feature_bank_fp=None):
+    if save_fp is None:
+        save_fp = os.path.splitext(model_fp)[0] + '.' + precision + '.npz'
+    np_models.save_quantized(model_fp, save_fp, precision)
+    print('Saved {} model to {} ({} -> {} bytes).'.format(
+        precision, save_fp, os.path.getsize(model_fp), os.path.getsize(save_fp)))
+    if feature_bank_fp is not None:
+        report(model_fp, feature_bank_fp)
+
+def parser():
+    import argparse
+    p = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=
+    """
+=======================================================================
+Script for converting classification models to float16 or int8 weights
+to store them in smaller files. Inference runs in float32.
+=======================================================================
+    """)
+
+    p.add_argument('model_fp', type=str, metavar='model_fp',
+                    help='The file path of the trained model (.npz).')
+    p.add_argument('precision', type=str, metavar='precision', choices=np_models.PRECISIONS,
+                    help='The storage type of the converted weights.')
+    p.add_argument('-o', '--save_fp', type=str,
+                    help='The file path of the converted model. Default: <model>.<precision>.npz')
+    p.add_argument('-f', '--feature_bank', type=str,
+                    help='A feature bank saved by classification.py. If given, report the accuracy lost by each precision on the test fold of the model.')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = parser()
+    main(args.model_fp, args.precision, args.save_fp, args.feature_bank)